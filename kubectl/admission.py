@@ -0,0 +1,372 @@
+"""
+
+Admission control for expensive routes: rate limits and load shedding
+
+"""
+import asyncio
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from typing import Any as A
+from typing import Awaitable, Callable
+from typing import Dict as D
+from typing import List as L
+from typing import Optional as O
+from typing import Tuple
+
+from aiohttp.web import Request, Response, json_response, middleware
+from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module
+
+from kubectl.client import client
+from kubectl.config import AUTH0_URL, env
+
+# How long a bearer token stays resolved to its user, and how many are kept
+CALLER_TTL = 300.0
+
+CALLER_CACHE = 10000
+
+# Auth0 lookups of unknown tokens allowed per client address
+LOOKUP_RATE = 0.5
+
+LOOKUP_BURST = 5
+
+# Refills a bucket stored as a hash and takes one token, atomically. Returns
+# whether the token was granted and, if not, how long until one is available.
+TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+
+class AdmissionPolicy(BaseModel):
+    """
+
+    Limits for one class of expensive routes
+
+    """
+
+    name: str = Field(..., description="Route class name")
+    routes: L[str] = Field(..., description="Method and canonical path of every route in the class")
+    user_rate: float = Field(..., description="Requests per second per user")
+    user_burst: float = Field(..., description="Requests a user may send at once")
+    route_rate: float = Field(..., description="Requests per second across all users")
+    route_burst: float = Field(..., description="Requests all users may send at once")
+    concurrency: int = Field(..., description="Requests in flight per worker")
+    queue: int = Field(..., description="Requests allowed to wait per worker before shedding")
+
+
+class TokenBucket:
+    """
+
+    Process-local bucket, used when Redis cannot be reached
+
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> Tuple[bool, float]:
+        """Take a token, returning whether it was granted and the wait otherwise"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True, 0.0
+        return False, (1 - self.tokens) / self.rate
+
+
+class Rejected(Exception):
+    """Request refused, with the seconds the client should wait"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Gate:
+    """
+
+    Bounds the requests of one route class in flight on this worker.
+
+    Excess requests wait in line; once `queue` are waiting, new ones are shed
+    with a Retry-After estimated from the recent service time.
+
+    """
+
+    def __init__(self, concurrency: int, queue: int):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.inflight = 0
+        self.waiting = 0
+        self.shed = 0
+        self.service_time = 1.0
+        self._semaphore: O[asyncio.Semaphore] = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        """Created lazily so it binds to the running loop"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def retry_after(self) -> float:
+        """Time for the current line to drain"""
+        return self.service_time * (self.waiting + 1) / self.concurrency
+
+    async def run(self, handler: Callable[..., Awaitable[A]], *args: A) -> A:
+        """Run `handler` once a slot is free, or shed the request"""
+        if self.semaphore.locked() and self.waiting >= self.queue:
+            self.shed += 1
+            raise Rejected("Server is saturated", self.retry_after())
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.inflight += 1
+        started = time.monotonic()
+        try:
+            return await handler(*args)
+        finally:
+            self.inflight -= 1
+            self.semaphore.release()
+            self.service_time = 0.8 * self.service_time + 0.2 * (time.monotonic() - started)
+
+
+class AdmissionController:
+    """
+
+    Token buckets per user and per route class, shared by every worker and
+    host through Redis, in front of a per-worker concurrency gate.
+
+    Only routes listed in a policy are controlled, everything else, such as
+    upload and container listings, goes straight to its handler and never
+    waits behind builds. Handlers that fan one request out into many units
+    of work, such as batch deploys, admit each unit through `admit`.
+
+    Callers are told apart by the Auth0 account their bearer token belongs
+    to, and otherwise by their address: the one the reverse proxy reports in
+    X-Real-IP or last in X-Forwarded-For when the request comes from a
+    `TRUSTED_PROXIES` address, the peer address otherwise. Path and query
+    parameters are chosen by the client, so they never pick a bucket. Tokens
+    not seen recently cost an Auth0 lookup, so those lookups are rate
+    limited per address before they are made.
+
+    """
+
+    def __init__(self, policies: L[AdmissionPolicy]):
+        self.named = {policy.name: policy for policy in policies}
+        self.policies = {route: policy for policy in policies for route in policy.routes}
+        self.callers: "OrderedDict[str, Tuple[O[str], float]]" = OrderedDict()
+        self.gates = {policy.name: Gate(policy.concurrency, policy.queue) for policy in policies}
+        self.local: D[str, TokenBucket] = {}
+        self.limited: D[str, int] = {policy.name: 0 for policy in policies}
+        self._script: A = None
+        self._redis_retry_at = 0.0
+
+    def policy(self, request: Request) -> O[AdmissionPolicy]:
+        """Policy of the route `request` matched, if any"""
+        resource = request.match_info.route.resource
+        if resource is None:
+            return None
+        return self.policies.get(f"{request.method} {resource.canonical}")
+
+    @staticmethod
+    def address(request: Request) -> str:
+        """Client address, as reported by the reverse proxy when it sent the request"""
+        remote = request.remote or "unknown"
+        if remote not in env.TRUSTED_PROXIES:
+            return remote
+        real = request.headers.get("X-Real-IP", "").strip()
+        if real:
+            return real
+        # Entries before the last one were sent by the client itself
+        forwarded = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",")]
+        return forwarded[-1] or remote
+
+    async def subject(self, token: str, address: str) -> O[str]:
+        """Auth0 user a bearer token was issued to, None if it is not valid.
+
+        Raises Rejected when `address` looks up too many unknown tokens.
+        """
+        digest = hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+        cached = self.callers.get(digest)
+        if cached is not None and cached[1] > time.monotonic():
+            self.callers.move_to_end(digest)
+            return cached[0]
+        allowed, wait = await self.take(f"admission:lookup:{address}", LOOKUP_RATE, LOOKUP_BURST)
+        if not allowed:
+            raise Rejected("Too many token lookups", wait)
+        try:
+            info = await client.fetch(
+                f"{AUTH0_URL}/userinfo", headers={"Authorization": f"Bearer {token}"}
+            )
+            sub = info.get("sub") if isinstance(info, dict) else None
+        except Exception:  # pylint: disable=broad-except
+            sub = None
+        self.callers[digest] = (sub, time.monotonic() + CALLER_TTL)
+        self.callers.move_to_end(digest)
+        while len(self.callers) > CALLER_CACHE:
+            self.callers.popitem(last=False)
+        return sub
+
+    async def caller(self, request: Request) -> str:
+        """Authenticated user of the request, or the address it came from"""
+        address = self.address(request)
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and token:
+            sub = await self.subject(token, address)
+            if sub:
+                return f"user:{sub}"
+        return f"addr:{address}"
+
+    async def take(self, key: str, rate: float, burst: float) -> Tuple[bool, float]:
+        """Take a token from the bucket `key`, in Redis when reachable"""
+        if time.monotonic() >= self._redis_retry_at:
+            try:
+                return await self._take_shared(key, rate, burst)
+            except Exception:  # pylint: disable=broad-except
+                self._redis_retry_at = time.monotonic() + 5.0
+        bucket = self.local.get(key)
+        if bucket is None:
+            bucket = self.local[key] = TokenBucket(rate, burst)
+        return bucket.take()
+
+    async def _take_shared(self, key: str, rate: float, burst: float) -> Tuple[bool, float]:
+        if self._script is None:
+            from kubectl.decorators import get_redis  # pylint: disable=import-outside-toplevel
+
+            self._script = get_redis().register_script(TOKEN_BUCKET)
+        allowed, wait = await self._script(keys=[key], args=[rate, burst, time.time()])
+        return bool(int(allowed)), float(wait)
+
+    async def check(self, policy: AdmissionPolicy, caller: str):
+        """Raise Rejected when the caller or the route class is over its rate"""
+        for key, rate, burst in (
+            (f"admission:{policy.name}:{caller}", policy.user_rate, policy.user_burst),
+            (f"admission:{policy.name}:route", policy.route_rate, policy.route_burst),
+        ):
+            allowed, wait = await self.take(key, rate, burst)
+            if not allowed:
+                self.limited[policy.name] += 1
+                raise Rejected("Rate limit exceeded", wait)
+
+    async def admit(
+        self, name: str, caller: str, func: Callable[[], Awaitable[A]], wait: float = 0.0
+    ) -> A:
+        """Run `func` as one request of the policy `name`.
+
+        Waits up to `wait` seconds for the rate limits to allow it, then raises
+        Rejected.
+        """
+        if not env.ADMISSION_ENABLED:
+            return await func()
+        policy = self.named[name]
+        deadline = time.monotonic() + wait
+        while True:
+            try:
+                await self.check(policy, caller)
+                break
+            except Rejected as e:
+                if time.monotonic() + e.retry_after > deadline:
+                    raise
+                await asyncio.sleep(e.retry_after)
+        return await self.gates[name].run(func)
+
+    def stats(self) -> D[str, A]:
+        """Queue depth, in-flight requests and rejections per route class"""
+        return {
+            name: {
+                "inflight": gate.inflight,
+                "waiting": gate.waiting,
+                "service_time_s": round(gate.service_time, 3),
+                "shed": gate.shed,
+                "rate_limited": self.limited[name],
+            }
+            for name, gate in self.gates.items()
+        }
+
+
+admission = AdmissionController(
+    [
+        AdmissionPolicy(
+            name="build",
+            # Batch deploys admit every item, see main.batch_deploy
+            routes=[
+                "POST /api/deploy/{owner}/{repo}",
+                "PUT /api/container/{name}",
+                "GET /api/docker/build/{owner}/{repo}",
+            ],
+            user_rate=0.1,
+            user_burst=3,
+            route_rate=1.0,
+            route_burst=10,
+            concurrency=env.DEPLOY_CONCURRENCY,
+            queue=4 * env.DEPLOY_CONCURRENCY,
+        ),
+        AdmissionPolicy(
+            name="codeserver",
+            routes=["GET /api/codeserver"],
+            user_rate=0.2,
+            user_burst=3,
+            route_rate=2.0,
+            route_burst=10,
+            concurrency=4,
+            queue=16,
+        ),
+        AdmissionPolicy(
+            name="database",
+            routes=["GET /api/db/{ref}"],
+            user_rate=0.2,
+            user_burst=3,
+            route_rate=2.0,
+            route_burst=10,
+            concurrency=4,
+            queue=16,
+        ),
+    ]
+)
+
+
+def too_many_requests(e: Rejected) -> Response:
+    """429 answer for a rejected request"""
+    return json_response(
+        {"message": e.reason, "status": "error"},
+        status=429,
+        headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+    )
+
+
+@middleware
+async def admission_control(request: Request, handler):
+    """Rate limit and shed expensive routes, answering 429 with Retry-After"""
+    policy = admission.policy(request) if env.ADMISSION_ENABLED else None
+    if policy is None:
+        return await handler(request)
+    try:
+        await admission.check(policy, await admission.caller(request))
+        return await admission.gates[policy.name].run(handler, request)
+    except Rejected as e:
+        return too_many_requests(e)
@@ -4,10 +4,14 @@ HTTP Client
 
 from typing import Any as A
 from typing import AsyncGenerator as AG
+from typing import Awaitable, Callable
 from typing import Dict as D
 from typing import Optional as O
 
-from aiohttp import ClientSession
+from aiohttp import ClientResponse, ClientSession
+
+from kubectl.tracing import tracer
+from kubectl.upstreams import RETRYABLE_STATUSES, UpstreamError, upstreams
 
 
 class APIClient:
@@ -15,8 +19,48 @@ class APIClient:
 
     Generic HTTP Client
 
+    Calls to a known upstream go through its deadline, retry, circuit breaker
+    and hedging policy, see `kubectl.upstreams`.
+
     """
 
+    async def request(
+        self,
+        url: str,
+        method: str,
+        headers: O[D[str, str]],
+        data: O[D[str, A]],
+        read: Callable[[ClientResponse], Awaitable[A]],
+    ) -> A:
+        """
+        Send a request and read its body with `read`, under the upstream policy
+        """
+        if method in ["GET", "DELETE"]:
+            data = None
+        elif method not in ["POST", "PUT", "PATCH"]:
+            raise ValueError("Invalid method")
+
+        upstream = upstreams.match(url)
+        with tracer.span(
+            f"{method} {upstream.policy.name if upstream else 'http'}", url=url
+        ) as span:
+
+            async def send():
+                async with ClientSession() as session:
+                    async with session.request(
+                        method, url, headers=headers, json=data
+                    ) as response:
+                        span.set(status=response.status)
+                        if response.status in RETRYABLE_STATUSES:
+                            raise UpstreamError(
+                                f"{method} {url} returned {response.status}", response.status
+                            )
+                        return await read(response)
+
+            if upstream is None:
+                return await send()
+            return await upstream.call(method, send)
+
     async def fetch(
         self,
         url: str,
@@ -27,18 +71,7 @@ class APIClient:
         """
         Generic function to retrieve data from an URL in json format
         """
-        if method in ["GET", "DELETE"]:
-            async with ClientSession() as session:
-                async with session.request(method, url, headers=headers) as response:
-                    return await response.json()
-        elif method in ["POST", "PUT", "PATCH"]:
-            async with ClientSession() as session:
-                async with session.request(
-                    method, url, headers=headers, json=data
-                ) as response:
-                    return await response.json()
-        else:
-            raise ValueError("Invalid method")
+        return await self.request(url, method, headers, data, lambda r: r.json())
 
     async def text(
         self,
@@ -50,18 +83,7 @@ class APIClient:
         """
         Generic function to retrieve data from an URL in text format
         """
-        if method in ["GET", "DELETE"]:
-            async with ClientSession() as session:
-                async with session.request(method, url, headers=headers) as response:
-                    return await response.text()
-        elif method in ["POST", "PUT", "PATCH"]:
-            async with ClientSession() as session:
-                async with session.request(
-                    method, url, headers=headers, json=data
-                ) as response:
-                    return await response.text()
-        else:
-            raise ValueError("Invalid method")
+        return await self.request(url, method, headers, data, lambda r: r.text())
 
     async def blob(
         self,
@@ -73,18 +95,7 @@ class APIClient:
         """
         Generic function to retrieve data from an URL in binary format
         """
-        if method in ["GET", "DELETE"]:
-            async with ClientSession() as session:
-                async with session.request(method, url, headers=headers) as response:
-                    return await response.read()
-        elif method in ["POST", "PUT", "PATCH"]:
-            async with ClientSession() as session:
-                async with session.request(
-                    method, url, headers=headers, json=data
-                ) as response:
-                    return await response.read()
-        else:
-            raise ValueError("Invalid method")
+        return await self.request(url, method, headers, data, lambda r: r.read())
 
     async def stream(
         self,
@@ -0,0 +1,125 @@
+"""
+
+Codecs for cached values
+
+"""
+import json
+import marshal
+import struct
+import zlib
+from typing import Any as A
+from typing import Dict as D
+from typing import Optional as O
+
+MAGIC = b"K"
+
+# Bump when the envelope itself changes, older values then read as misses
+FORMAT_VERSION = 1
+
+COMPRESSED = 0x01
+
+HEADER = struct.Struct(">cBBB")
+
+
+class Codec:
+    """
+
+    Turns a JSON-compatible value into bytes and back. `id` is stored in
+    every envelope, so it must never be reused for a different format.
+
+    """
+
+    id: int = 0
+    name: str = ""
+
+    def encode(self, value: A) -> bytes:
+        """Serialize `value`"""
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> A:
+        """Deserialize what `encode` produced"""
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """Compact JSON, readable from any client"""
+
+    id = 1
+    name = "json"
+
+    def encode(self, value: A) -> bytes:
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, data: bytes) -> A:
+        return json.loads(data)
+
+
+class MarshalCodec(Codec):
+    """
+
+    Binary, several times faster than JSON for nested dicts and lists. The
+    format may change between Python versions and dict subclasses are
+    rejected, so only use it when every reader runs the same interpreter.
+
+    """
+
+    id = 2
+    name = "marshal"
+
+    def encode(self, value: A) -> bytes:
+        return marshal.dumps(value, 4)
+
+    def decode(self, data: bytes) -> A:
+        return marshal.loads(data)
+
+
+codecs: D[int, Codec] = {}
+
+
+def register_codec(codec: Codec) -> Codec:
+    """Make `codec` available for encoding by name and for decoding by id"""
+    if codec.id in codecs and codecs[codec.id].name != codec.name:
+        raise ValueError(f"Codec id {codec.id} is taken by {codecs[codec.id].name}")
+    codecs[codec.id] = codec
+    return codec
+
+
+def get_codec(name: str) -> Codec:
+    """Registered codec by name"""
+    for codec in codecs.values():
+        if codec.name == name:
+            return codec
+    raise KeyError(f"Unknown codec {name}")
+
+
+register_codec(JsonCodec())
+register_codec(MarshalCodec())
+
+
+def pack(value: A, codec: Codec, compress_min: int = 1024) -> bytes:
+    """Encode `value` behind a header naming the format, compressing large payloads"""
+    data = codec.encode(value)
+    flags = 0
+    if len(data) >= compress_min:
+        compressed = zlib.compress(data, 1)
+        if len(compressed) < len(data):
+            data, flags = compressed, COMPRESSED
+    return HEADER.pack(MAGIC, FORMAT_VERSION, codec.id, flags) + data
+
+
+def unpack(data: O[bytes]) -> O[A]:
+    """Decode a packed value, or None when it is missing, corrupt or in a format this build cannot read"""
+    if not data or len(data) < HEADER.size:
+        return None
+    magic, version, codec_id, flags = HEADER.unpack_from(data)
+    codec = codecs.get(codec_id)
+    if magic != MAGIC or version != FORMAT_VERSION or codec is None:
+        return None
+    payload = data[HEADER.size :]
+    try:
+        if flags & COMPRESSED:
+            payload = zlib.decompress(payload)
+        return codec.decode(payload)
+    except (zlib.error, EOFError, ValueError, TypeError):
+        # Truncated or corrupt, or written by another interpreter version
+        return None
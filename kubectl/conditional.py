@@ -0,0 +1,69 @@
+"""
+
+Conditional GET and compression for JSON responses
+
+"""
+import hashlib
+
+from typing import Optional as O
+
+from aiohttp.payload import BytesPayload
+from aiohttp.web import ContentCoding, Request, Response, middleware
+
+from kubectl.config import env
+
+
+def etag(body: bytes) -> str:
+    """Weak validator of a response body, weak because compression changes the bytes"""
+    return f'W/"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def matches(if_none_match: str, tag: str) -> bool:
+    """Whether an If-None-Match header lists `tag`, compared weakly"""
+    def opaque(value: str) -> str:
+        return value[2:] if value.startswith("W/") else value
+
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or opaque(tag) in [opaque(c) for c in candidates]
+
+
+def body_bytes(response: Response) -> O[bytes]:
+    """Body of a buffered response; handlers returning dicts get a str payload"""
+    if isinstance(response.body, bytes):
+        return response.body
+    if isinstance(response.body, BytesPayload):
+        return response.body._value  # pylint: disable=protected-access
+    return None
+
+
+@middleware
+async def conditional_json(request: Request, handler):
+    """Tag JSON GET responses, answer revalidations with 304 and gzip large bodies.
+
+    Polling clients that send back the ETag get an empty 304 when nothing
+    changed; bodies over `GZIP_MIN_SIZE` bytes are compressed for clients
+    that accept gzip.
+    """
+    response = await handler(request)
+    if (
+        request.method not in ("GET", "HEAD")
+        or response.status != 200
+        or not isinstance(response, Response)
+        or response.content_type != "application/json"
+    ):
+        return response
+    body = body_bytes(response)
+    if body is None:
+        return response
+    tag = response.headers.get("ETag") or etag(body)
+    headers = {
+        "ETag": tag,
+        "Cache-Control": response.headers.get("Cache-Control", "no-cache"),
+        "Vary": "Accept-Encoding",
+    }
+    if matches(request.headers.get("If-None-Match", ""), tag):
+        return Response(status=304, headers=headers)
+    response.headers.update(headers)
+    if len(body) >= env.GZIP_MIN_SIZE and "gzip" in request.headers.get("Accept-Encoding", ""):
+        response.enable_compression(ContentCoding.gzip)
+    return response
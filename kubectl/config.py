@@ -1,6 +1,8 @@
 """
 Configuration
 """
+from typing import List as L
+
 from pydantic import BaseConfig, BaseSettings, Field
 
 
@@ -33,6 +35,44 @@ class Env(BaseSettings):  # pylint: disable=too-few-public-methods
     CF_ZONE_ID: str = Field(..., env="CF_ZONE_ID")
     CF_ACCOUNT_ID: str = Field(..., env="CF_ACCOUNT_ID")
     IP_ADDR: str = Field(..., env="IP_ADDR")
+    PORT_RANGE_START: int = Field(20000, env="PORT_RANGE_START")
+    PORT_RANGE_END: int = Field(30000, env="PORT_RANGE_END")
+    PORT_LEASES_PATH: str = Field(".ports", env="PORT_LEASES_PATH")
+    DEPLOY_CONCURRENCY: int = Field(4, env="DEPLOY_CONCURRENCY")
+    DEPLOY_ADMISSION_WAIT: float = Field(600.0, env="DEPLOY_ADMISSION_WAIT")
+    DOCKER_URL: str = Field("https://doctl.smartpro.solutions", env="DOCKER_URL")
+    GITHUB_URL: str = Field("https://api.github.com", env="GITHUB_URL")
+    CLOUDFLARE_URL: str = Field("https://api.cloudflare.com/client/v4", env="CLOUDFLARE_URL")
+    AUTH0_URL: str = Field("https://dev-tvhqmk7a.us.auth0.com", env="AUTH0_URL")
+    TRACE_SAMPLE_RATE: float = Field(1.0, env="TRACE_SAMPLE_RATE")
+    TRACE_BUFFER: int = Field(256, env="TRACE_BUFFER")
+    NGINX_CONF_DIRS: L[str] = Field(
+        ["/etc/nginx/conf.d", "/etc/nginx/sites-available", "/etc/nginx/sites-enabled"],
+        env="NGINX_CONF_DIRS",
+    )
+    NGINX_RELOAD_CMD: str = Field("nginx -s reload", env="NGINX_RELOAD_CMD")
+    WORKERS: int = Field(1, env="WORKERS")
+    LOCK_DIR: str = Field(".locks", env="LOCK_DIR")
+    LOG_HISTORY: int = Field(500, env="LOG_HISTORY")
+    STREAM_QUEUE_SIZE: int = Field(256, env="STREAM_QUEUE_SIZE")
+    STREAM_LINGER: float = Field(30.0, env="STREAM_LINGER")
+    IDLE_TIMEOUT: float = Field(0.0, env="IDLE_TIMEOUT")
+    IDLE_CHECK_INTERVAL: float = Field(60.0, env="IDLE_CHECK_INTERVAL")
+    IDLE_WAKE_TIMEOUT: float = Field(60.0, env="IDLE_WAKE_TIMEOUT")
+    IDLE_STATE_PATH: str = Field(".idle.json", env="IDLE_STATE_PATH")
+    NGINX_LOG_DIR: str = Field("/var/log/nginx", env="NGINX_LOG_DIR")
+    WAKE_URL: str = Field("http://127.0.0.1:8080", env="WAKE_URL")
+    GITHUB_WEBHOOK_SECRET: str = Field("", env="GITHUB_WEBHOOK_SECRET")
+    REDEPLOY_DEBOUNCE: float = Field(15.0, env="REDEPLOY_DEBOUNCE")
+    REDEPLOY_HEALTH_TIMEOUT: float = Field(120.0, env="REDEPLOY_HEALTH_TIMEOUT")
+    REDEPLOY_DRAIN: float = Field(5.0, env="REDEPLOY_DRAIN")
+    ADMISSION_ENABLED: bool = Field(True, env="ADMISSION_ENABLED")
+    TRUSTED_PROXIES: L[str] = Field(["127.0.0.1", "::1"], env="TRUSTED_PROXIES")
+    GZIP_MIN_SIZE: int = Field(1024, env="GZIP_MIN_SIZE")
+    TEMPLATE_CACHE_DIR: str = Field(".templates", env="TEMPLATE_CACHE_DIR")
+    CACHE_CODEC: str = Field("json", env="CACHE_CODEC")
+    CACHE_COMPRESS_MIN: int = Field(1024, env="CACHE_COMPRESS_MIN")
+    USAGE_RECONCILE_INTERVAL: float = Field(600.0, env="USAGE_RECONCILE_INTERVAL")
 
     def __init__(self, **data):  # pylint: disable=useless-super-delegation
         super().__init__(**data)
@@ -43,11 +83,13 @@ env = Env()
 
 # API Endpoints
 
-DOCKER_URL = "https://doctl.smartpro.solutions"
+DOCKER_URL = env.DOCKER_URL
+
+GITHUB_URL = env.GITHUB_URL
 
-GITHUB_URL = "https://api.github.com"
+CLOUDFLARE_URL = env.CLOUDFLARE_URL
 
-CLOUDFLARE_URL = "https://api.cloudflare.com/client/v4"
+AUTH0_URL = env.AUTH0_URL
 
 # API Headers
 
@@ -0,0 +1,301 @@
+"""
+
+In-memory container index fed by the Docker events stream
+
+"""
+import asyncio
+import json
+import time
+from typing import Any as A
+from typing import Dict as D
+from typing import List as L
+from typing import Optional as O
+
+from aiohttp import ClientSession, ClientTimeout
+from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module
+
+from kubectl.client import client
+from kubectl.config import DOCKER_URL
+
+EVENT_STATES = {
+    "create": "created",
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+    "kill": "exited",
+    "oom": "exited",
+}
+
+
+class ContainerRecord(BaseModel):
+    """
+
+    Indexed container state
+
+    """
+
+    id: str = Field(..., description="Container id")
+    name: str = Field(..., description="Container name, without the leading slash")
+    state: str = Field(..., description="Container state")
+    image: O[str] = Field(None, description="Image the container runs")
+    ports: L[int] = Field([], description="Host ports bound by the container, running or not")
+    data: O[D[str, A]] = Field(None, description="Last inspect payload, if any")
+
+
+def _published_ports(ports: A) -> L[int]:
+    """Extract host ports from either a listing or an inspect payload"""
+    if isinstance(ports, list):
+        return sorted({p["PublicPort"] for p in ports if p.get("PublicPort")})
+    if isinstance(ports, dict):
+        return sorted(
+            {
+                int(binding["HostPort"])
+                for bindings in ports.values()
+                if bindings
+                for binding in bindings
+                if binding.get("HostPort")
+            }
+        )
+    return []
+
+
+class ContainerIndex:
+    """
+
+    Keeps name, id, state and ports of every container on the Docker host.
+
+    A single full listing seeds the index, the `/events` stream keeps it up to
+    date and any disconnect triggers a resync, so lookups never hit Docker.
+
+    """
+
+    def __init__(self, url: str = DOCKER_URL, backoff: float = 1.0):
+        self.url = url
+        self.backoff = backoff
+        self.by_id: D[str, ContainerRecord] = {}
+        self.by_name: D[str, ContainerRecord] = {}
+        self.ready = False
+        self._lock: O[asyncio.Lock] = None
+        self._changed: O[asyncio.Condition] = None
+        self._task: O[asyncio.Task] = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        """Sync lock, created lazily so it binds to the running loop"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @property
+    def changed(self) -> asyncio.Condition:
+        """Condition notified whenever the index changes"""
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    def get(self, key: str) -> O[ContainerRecord]:
+        """Lookup a container by name or (full or short) id"""
+        key = key.lstrip("/")
+        record = self.by_name.get(key) or self.by_id.get(key)
+        if record is None and len(key) == 12:
+            record = next((r for r in self.by_id.values() if r.id.startswith(key)), None)
+        return record
+
+    async def lookup(self, key: str) -> O[ContainerRecord]:
+        """Lookup that resyncs first when the stream is down"""
+        if not self.ready:
+            await self.sync()
+        return self.get(key)
+
+    def put(self, record: ContainerRecord):
+        """Insert or replace a record"""
+        self.discard(record.id)
+        self.by_id[record.id] = record
+        self.by_name[record.name] = record
+
+    def discard(self, id_: str):
+        """Remove a record by id"""
+        record = self.by_id.pop(id_, None)
+        if record is not None and self.by_name.get(record.name) is record:
+            del self.by_name[record.name]
+
+    async def sync(self):
+        """Rebuild the index from one full listing.
+
+        Listings only show the ports of running containers, so stopped ones
+        are inspected for the bindings they take back when started.
+        """
+        async with self.lock:
+            if self.ready:
+                return
+            containers = await client.fetch(f"{self.url}/containers/json?all=true")
+            self.by_id.clear()
+            self.by_name.clear()
+            for container in containers:
+                self.put(
+                    ContainerRecord(
+                        id=container["Id"],
+                        name=container["Names"][0].lstrip("/"),
+                        state=container["State"],
+                        image=container.get("Image"),
+                        ports=_published_ports(container.get("Ports")),
+                    )
+                )
+            stopped = [record.id for record in self.by_id.values() if record.state != "running"]
+            await asyncio.gather(*[self.inspect(id_) for id_ in stopped], return_exceptions=True)
+            self.ready = True
+        await self._notify()
+
+    async def inspect(self, id_: str) -> O[ContainerRecord]:
+        """Refresh a single record from `/containers/{id}/json`"""
+        data = await client.fetch(f"{self.url}/containers/{id_}/json")
+        if not isinstance(data, dict) or "Id" not in data:
+            return None
+        record = ContainerRecord(
+            id=data["Id"],
+            name=data["Name"].lstrip("/"),
+            state=data["State"]["Status"],
+            image=data.get("Config", {}).get("Image"),
+            # Bindings are configured on create, published ports only while running
+            ports=sorted(
+                {
+                    *_published_ports((data.get("HostConfig") or {}).get("PortBindings")),
+                    *_published_ports((data.get("NetworkSettings") or {}).get("Ports")),
+                }
+            ),
+            data=data,
+        )
+        self.put(record)
+        return record
+
+    async def apply(self, event: D[str, A]):
+        """Apply a single container event to the index"""
+        if event.get("Type") != "container":
+            return
+        action = event.get("Action", "").split(":")[0]
+        actor = event.get("Actor", {})
+        id_ = actor.get("ID") or event.get("id")
+        attributes = actor.get("Attributes", {})
+        if not id_:
+            return
+        if action == "destroy":
+            self.discard(id_)
+        elif action in ("create", "start", "restart"):
+            # Ports are only known once Docker has bound them
+            await self.inspect(id_)
+        elif action == "rename":
+            record = self.by_id.get(id_)
+            if record is not None:
+                self.put(record.copy(update={"name": attributes["name"].lstrip("/")}))
+        elif action in EVENT_STATES:
+            record = self.by_id.get(id_)
+            if record is None:
+                await self.inspect(id_)
+            else:
+                self.put(record.copy(update={"state": EVENT_STATES[action]}))
+        else:
+            return
+        await self._notify()
+
+    async def _notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def wait_for(
+        self, key: str, state: str = "running", timeout: float = 10.0
+    ) -> O[ContainerRecord]:
+        """Wait until the indexed container reaches `state`, without polling Docker.
+
+        Returns None straight away while the stream is down so callers can fall
+        back to a direct inspect.
+        """
+        if not self.ready:
+            return None
+
+        def reached():
+            record = self.get(key)
+            return record is not None and record.state == state
+
+        try:
+            async with self.changed:
+                await asyncio.wait_for(self.changed.wait_for(reached), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self.get(key)
+
+    async def wait_healthy(
+        self, id_: str, port: int, timeout: float = 60.0, host: str = "127.0.0.1"
+    ) -> bool:
+        """Wait until the container serves requests, return whether it did in time.
+
+        A container with a HEALTHCHECK is ready once Docker reports it healthy.
+        Otherwise an HTTP request to `port` must get a non-5xx answer: Docker's
+        proxy accepts connections on a published port before the app listens,
+        so a bare TCP connect proves nothing.
+        """
+        deadline = time.monotonic() + timeout
+        async with ClientSession(timeout=ClientTimeout(total=2.0)) as session:
+            while time.monotonic() < deadline:
+                try:
+                    record = await self.inspect(id_)
+                    if record is None or record.state in ("exited", "dead"):
+                        return False
+                    health = (record.data or {}).get("State", {}).get("Health")
+                    if health is not None:
+                        if health.get("Status") == "healthy":
+                            return True
+                    else:
+                        async with session.get(
+                            f"http://{host}:{port}/", allow_redirects=False
+                        ) as response:
+                            if response.status < 500:
+                                return True
+                except asyncio.CancelledError:
+                    raise
+                except Exception:  # pylint: disable=broad-except
+                    pass
+                await asyncio.sleep(0.5)
+        return False
+
+    async def listen(self):
+        """Consume the events stream, resyncing after every disconnect"""
+        filters = json.dumps({"type": ["container"]})
+        while True:
+            try:
+                async with ClientSession(timeout=ClientTimeout(total=None)) as session:
+                    async with session.get(
+                        f"{self.url}/events", params={"filters": filters}
+                    ) as response:
+                        # Subscribe before listing so nothing falls in between
+                        self.ready = False
+                        await self.sync()
+                        async for line in response.content:
+                            if line.strip():
+                                await self.apply(json.loads(line))
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                pass
+            self.ready = False
+            await asyncio.sleep(self.backoff)
+
+    def start(self):
+        """Start the background subscriber"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.listen())
+
+    async def stop(self):
+        """Stop the background subscriber"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+container_index = ContainerIndex()
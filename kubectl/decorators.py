@@ -4,42 +4,116 @@ Non-handler functions decorators
 
 """
 import base64
-import json
-from functools import wraps
+from functools import lru_cache, wraps
+from typing import Any as A
+from typing import Dict as D
+from typing import Iterable
+from typing import List as L
+from typing import Optional as O
 
-import aioredis
 from aiohttp.web import Application, Request, WebSocketResponse
 
+from kubectl.codecs import Codec, get_codec, pack, unpack
 from kubectl.config import env
 
-redis = aioredis.from_url(
-    f"redis://{env.REDIS_HOST}:{env.REDIS_PORT}",
-    password=env.REDIS_PASSWORD,
-    encoding="utf-8",
-    decode_responses=True,
-    db=0,
-)
 
+@lru_cache(maxsize=None)
+def get_redis():
+    """Shared Redis client, aioredis is imported and the pool built on first use.
 
-def cache(ttl: int = 3600):
+    Responses are bytes, cached values are binary envelopes.
+    """
+    import aioredis  # pylint: disable=import-outside-toplevel
+
+    return aioredis.from_url(
+        f"redis://{env.REDIS_HOST}:{env.REDIS_PORT}",
+        password=env.REDIS_PASSWORD,
+        decode_responses=False,
+        db=0,
+    )
+
+
+class CacheStore:
+    """
+
+    Reads and writes cached values through a codec. Multi-key operations
+    are sent as a single round trip.
+
+    """
+
+    def __init__(self, codec: O[Codec] = None):
+        self._codec = codec
+
+    @property
+    def codec(self) -> Codec:
+        """Codec new values are written with, `CACHE_CODEC` unless given"""
+        if self._codec is None:
+            self._codec = get_codec(env.CACHE_CODEC)
+        return self._codec
+
+    def pack(self, value: A) -> bytes:
+        """Envelope for `value`"""
+        return pack(value, self.codec, env.CACHE_COMPRESS_MIN)
+
+    async def get(self, key: str) -> O[A]:
+        """Cached value, None on a miss or an unreadable format"""
+        return unpack(await get_redis().get(key))
+
+    async def set(self, key: str, value: A, ttl: int):
+        """Cache `value` for `ttl` seconds"""
+        await get_redis().set(key, self.pack(value), ex=ttl)
+
+    async def get_many(self, keys: Iterable[str]) -> D[str, A]:
+        """Cached values of every key that hit, in one MGET"""
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = await get_redis().mget(keys)
+        found = {key: unpack(value) for key, value in zip(keys, values)}
+        return {key: value for key, value in found.items() if value is not None}
+
+    async def set_many(self, values: D[str, A], ttl: int):
+        """Cache every value for `ttl` seconds, pipelined"""
+        if not values:
+            return
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for key, value in values.items():
+                pipe.set(key, self.pack(value), ex=ttl)
+            await pipe.execute()
+
+    async def delete_many(self, keys: L[str]):
+        """Drop cached values"""
+        if keys:
+            await get_redis().delete(*keys)
+
+
+store = CacheStore()
+
+
+def cache_key(func, args, kwargs) -> str:
+    """Key of a call to `func`"""
+    return base64.b64encode(f"{func.__name__}{args}{kwargs}".encode("utf-8")).decode("utf-8")
+
+
+def cache(ttl: int = 3600, codec: O[str] = None):
     """
 
     Stores the results of a given function within a ttl frame on redis
 
     """
+    cache_store = CacheStore(get_codec(codec)) if codec else store
 
     def decorator(func):
-        async def wrapper(*args, **kwargs) -> str:
-            key = base64.b64encode(
-                f"{func.__name__}{args}{kwargs}".encode("utf-8")
-            ).decode("utf-8")
-            cached = await redis.get(key)
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = cache_key(func, args, kwargs)
+            cached = await cache_store.get(key)
             if cached:
-                return json.loads(cached)
+                return cached
             result = await func(*args, **kwargs)
-            await redis.set(key, json.dumps(result), ex=ttl)
+            await cache_store.set(key, result, ttl)
             return result
 
         return wrapper
 
-    return decorator
\ No newline at end of file
+    return decorator
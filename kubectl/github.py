@@ -0,0 +1,89 @@
+"""
+
+GitHub API access with conditional requests and in-flight coalescing
+
+"""
+import asyncio
+from collections import OrderedDict
+from typing import Any as A
+from typing import Dict as D
+from typing import NamedTuple
+from typing import Optional as O
+
+from aiohttp import ClientResponse
+
+from kubectl.client import APIClient
+from kubectl.config import GITHUB_HEADERS, GITHUB_URL
+
+
+class Validated(NamedTuple):
+    """Cached payload with the validators GitHub returned for it"""
+
+    etag: O[str]
+    last_modified: O[str]
+    payload: A
+
+
+class GithubClient(APIClient):
+    """
+
+    GitHub HTTP Client
+
+    GETs are revalidated with `If-None-Match` / `If-Modified-Since`, so an
+    unchanged resource comes back as a 304 that does not count against the
+    rate limit, and identical concurrent GETs share a single request.
+
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._cache: "OrderedDict[str, Validated]" = OrderedDict()
+        self._inflight: D[str, asyncio.Future] = {}
+
+    async def get(self, url: str) -> A:
+        """Conditional, coalesced GET returning the json payload"""
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._revalidate(url))
+            self._inflight[url] = task
+            task.add_done_callback(lambda done: self._forget(url, done))
+        # Shielded so one caller going away does not cancel the shared request
+        return await asyncio.shield(task)
+
+    def _forget(self, url: str, task: asyncio.Future):
+        if self._inflight.get(url) is task:
+            del self._inflight[url]
+
+    async def _revalidate(self, url: str) -> A:
+        headers = dict(GITHUB_HEADERS)
+        cached = self._cache.get(url)
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        async def read(response: ClientResponse) -> A:
+            if response.status == 304 and cached is not None:
+                self._cache.move_to_end(url)
+                return cached.payload
+            response.raise_for_status()
+            payload = await response.json()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if etag or last_modified:
+                self._cache[url] = Validated(etag, last_modified, payload)
+                self._cache.move_to_end(url)
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+            return payload
+
+        return await self.request(url, "GET", headers, None, read)
+
+    async def latest_commit_sha(self, owner: str, repo: str) -> str:
+        """SHA of the newest commit on the default branch"""
+        payload = await self.get(f"{GITHUB_URL}/repos/{owner}/{repo}/commits?per_page=1")
+        return payload[0]["sha"]
+
+
+github = GithubClient()
@@ -1,18 +1,36 @@
 """Non decorated API Request Handlers"""
+import asyncio
+import hashlib
+import hmac
 import json
 
 from aiofauna import Api, FaunaClient, q
 from aiohttp import ClientSession
-from aiohttp.web import WebSocketResponse
+from aiohttp.web import (HTTPServiceUnavailable, HTTPUnauthorized, Request,
+                         Response, WebSocketResponse)
 
+from kubectl.admission import admission, admission_control
 from kubectl.client import client
-from kubectl.config import DOCKER_URL, GITHUB_HEADERS, env
+from kubectl.conditional import conditional_json
+from kubectl.config import DOCKER_URL, GITHUB_URL, env
+from kubectl.containers import container_index
+from kubectl.github import github
 from kubectl.helpers import provision_instance
-from kubectl.models import CodeServer, DatabaseKey
-from kubectl.payload import GithubWebhookPayload
+from kubectl.idle import idle_manager
+from kubectl.models import CodeServer, Container, DatabaseKey
+from kubectl.payload import GithubPushPayload
+from kubectl.redeploy import redeployer
+from kubectl.scanner import scanner
+from kubectl.streams import hub
+from kubectl.tracing import trace_requests, tracer
+from kubectl.upstreams import upstreams
 
 app = Api()
 
+app.middlewares.append(trace_requests)
+app.middlewares.append(admission_control)
+app.middlewares.append(conditional_json)
+
 @app.get("/api/docker/build/{owner}/{repo}")
 async def docker_build_from_github_tarball(owner: str, repo: str):
     """
@@ -22,17 +40,24 @@ async def docker_build_from_github_tarball(owner: str, repo: str):
     :return: The output of the Docker build.
     """
     sha = await get_latest_commit_sha(owner, repo)
-    tarball_url = f"https://api.github.com/repos/{owner}/{repo}/tarball/{sha}"
+    return await build_image(owner, repo, sha)
+
+
+async def build_image(owner: str, repo: str, sha: str) -> str:
+    """Build the repository at commit `sha`, returning the image id"""
+    tarball_url = f"{GITHUB_URL}/repos/{owner}/{repo}/tarball/{sha}"
     local_path = f"{owner}-{repo}-{sha[:7]}"
     build_args = json.dumps({"LOCAL_PATH": local_path})
-    async with ClientSession() as session:
-        async with session.post(
-            f"{DOCKER_URL}/build?remote={tarball_url}&dockerfile={local_path}/Dockerfile&buildargs={build_args}"
-        ) as response:
-            streamed_data = await response.text()
-            id_ = streamed_data.split("Successfully built ")[1].split("\\n")[0]
-            return id_
-    
+    with tracer.span("docker.build", owner=owner, repo=repo, sha=sha) as span:
+        async with ClientSession() as session:
+            async with session.post(
+                f"{DOCKER_URL}/build?remote={tarball_url}&dockerfile={local_path}/Dockerfile&buildargs={build_args}"
+            ) as response:
+                streamed_data = await response.text()
+                id_ = streamed_data.split("Successfully built ")[1].split("\\n")[0]
+                span.set(status=response.status, image=id_)
+                return id_
+
 @app.websocket("/api/docker/pull/{image}")
 async def docker_pull(ws: WebSocketResponse, image: str):
     """
@@ -55,11 +80,25 @@ async def get_latest_commit_sha(owner: str, repo: str) -> str:
     Gets the SHA of the latest commit in the repository.
     """
 
-    url = f"https://api.github.com/repos/{owner}/{repo}/commits"
+    return await github.latest_commit_sha(owner, repo)
+
 
-    payload = await client.fetch(url, headers=GITHUB_HEADERS)
+@app.get("/api/upstreams")
+async def get_upstream_stats():
+    """Latency percentiles, error counts and breaker state per upstream"""
+    return upstreams.stats()
 
-    return payload[0]["sha"]
+
+@app.get("/api/admission")
+async def get_admission_stats():
+    """Queue depth, in-flight requests and rejections per expensive route class"""
+    return admission.stats()
+
+
+@app.get("/api/traces")
+async def get_traces(request: Request):
+    """Recent request traces with their critical path, `?limit=` of them (20 by default)"""
+    return tracer.recent(int(request.query.get("limit", 20)))
 
 
 @app.get("/api/docker/start/{container}")
@@ -86,6 +125,8 @@ async def get_code_server_image(ref:str):
     
     instance = CodeServer(user=ref)
     
+    await instance.prepare_volumes()
+
     codeserver_instance = instance.payload
     
     container_instance = await client.fetch(f"{DOCKER_URL}/containers/create", method="POST", data=codeserver_instance)
@@ -97,14 +138,22 @@ async def get_code_server_image(ref:str):
     assert isinstance(instance, CodeServer)
     
     await client.text(f"{DOCKER_URL}/containers/{_id}/start", method="POST")
+
+    # Stats, logs and later calls for this user find the container through the record
+    await instance.save()
     
-    container_info = await client.fetch(f"{DOCKER_URL}/containers/{_id}/json", method="GET")
+    with tracer.span("docker.wait_running", id=_id):
+        record = await container_index.wait_for(_id, "running")
+    if record is not None and record.data is not None:
+        container_info = record.data
+    else:
+        container_info = await client.fetch(f"{DOCKER_URL}/containers/{_id}/json", method="GET")
     
     assert isinstance(instance.port,int)
     assert isinstance(instance.proxy_port,int)
     
-    provision_info = await provision_instance(ref,instance.port)
-    proxy_info = await provision_instance(_id,instance.proxy_port)
+    provision_info = await provision_instance(ref,instance.port,container=_id)
+    proxy_info = await provision_instance(_id,instance.proxy_port,container=_id)
     
     return {
         "container_id": _id,
@@ -117,6 +166,117 @@ async def get_code_server_image(ref:str):
     }
     
     
+@app.websocket("/api/workspace/{user}")
+async def browse_workspace(ws: WebSocketResponse, request: Request, user: str):
+    """
+    Streams the code server workspace tree of a user in batches of nodes.
+
+    Query parameters: `max_depth` (default 8) and `content` (`true` to include
+    the text of small files).
+    """
+    if "/" in user or user.startswith("."):
+        await ws.send_json({"message": "Invalid user", "status": "error"})
+        return await ws.close()
+    # Read by hand: aiofauna hands the Request to scalar parameters missing
+    # from the query, and bool("false") is True
+    try:
+        max_depth = int(request.query.get("max_depth", 8))
+    except ValueError:
+        await ws.send_json({"message": "Invalid max_depth", "status": "error"})
+        return await ws.close()
+    content = request.query.get("content", "").lower() in ("1", "true", "yes")
+    async for nodes in scanner.aiter_tree(
+        f"./.vscode/{user}/config/workspace", max_depth=max_depth, content=content
+    ):
+        await ws.send_json(nodes)
+    await ws.close()
+
+
+@app.get("/api/workspace/{user}/size")
+async def get_workspace_size(user: str):
+    """Size in bytes of a user's code server volumes"""
+    if "/" in user or user.startswith("."):
+        return {"message": "Invalid user", "status": "error"}
+    return {"user": user, "size": await scanner.adir_size(f"./.vscode/{user}")}
+
+
+async def resolve_container(name: str, user: str):
+    """Docker id of a Container or CodeServer owned by the given user"""
+    instance = await Container.find_unique("name", name)
+    if isinstance(instance, Container) and instance.user == user:
+        # Rolling redeploys replace the Docker container under a new name
+        record = await container_index.lookup(instance.container_id or name)
+        return record.id if record is not None else None
+    code_server = await CodeServer.find_unique("user", user)
+    if isinstance(code_server, CodeServer) and name in (user, code_server.container_id):
+        return code_server.container_id
+    return None
+
+
+async def fan_out(ws: WebSocketResponse, kind: str, name: str, user: str):
+    """Relay a shared stats or logs channel to one websocket"""
+    container_id = await resolve_container(name, user)
+    if container_id is None:
+        await ws.send_json({"message": "Container not found", "status": "error"})
+        return await ws.close()
+    channel, queue = hub.subscribe(kind, container_id)
+
+    async def pump():
+        while True:
+            await ws.send_json(await queue.get())
+
+    sender = asyncio.ensure_future(pump())
+    try:
+        async for _ in ws:
+            pass
+    finally:
+        sender.cancel()
+        channel.unsubscribe(queue)
+
+
+@app.websocket("/api/stats/{name}")
+async def container_stats(ws: WebSocketResponse, name: str, user: str):
+    """Live resource usage of one of the user's containers"""
+    await fan_out(ws, "stats", name, user)
+
+
+@app.websocket("/api/logs/{name}")
+async def container_logs(ws: WebSocketResponse, name: str, user: str):
+    """Live logs of one of the user's containers, starting with the recent lines"""
+    await fan_out(ws, "logs", name, user)
+
+
+@app.get("/api/streams")
+async def get_stream_stats():
+    """Open stats and logs channels"""
+    return hub.stats()
+
+
+@app.get("/api/wake/{site}")
+async def wake_site(request: Request, site: str):
+    """Start a site's stopped container, then send the held request back to it.
+
+    nginx routes here when the upstream refuses connections, with the original
+    path in `X-Original-URI`.
+    """
+    if not await idle_manager.wake(site):
+        raise HTTPServiceUnavailable(headers={"Retry-After": "5"})
+    uri = request.headers.get("X-Original-URI", "/")
+    return Response(
+        status=307,
+        headers={
+            "Location": f"https://{request.host}{uri}",
+            "Cache-Control": "no-store",
+        },
+    )
+
+
+@app.get("/api/idle")
+async def get_idle_stats():
+    """Sites under scale-to-zero with their idle time"""
+    return idle_manager.stats()
+
+
 @app.get("/api/db/{ref}")
 async def get_database_key(ref:str):
     """Get the database key"""
@@ -149,8 +309,33 @@ async def get_database_key(ref:str):
         return {"message": str(e), "status": "error"}
     
 @app.post("/api/webhook/github/auth")
-async def github_auth(webhook_payload:dict):
-    print(webhook_payload)
-    return {
-        "status":"OK"
-    }
\ No newline at end of file
+async def github_auth(request: Request):
+    """GitHub webhook, push events schedule a rolling redeploy of the branch"""
+    if not env.GITHUB_WEBHOOK_SECRET:
+        # Unsigned deliveries would let anyone trigger builds
+        raise HTTPServiceUnavailable(text="GITHUB_WEBHOOK_SECRET is not set")
+    body = await request.read()
+    digest = hmac.new(env.GITHUB_WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(f"sha256={digest}", request.headers.get("X-Hub-Signature-256", "")):
+        raise HTTPUnauthorized()
+    event = request.headers.get("X-GitHub-Event")
+    if event != "push":
+        return {"status": "OK", "event": event}
+    push = GithubPushPayload.parse_raw(body)
+    if push.deleted or not push.ref.startswith("refs/heads/"):
+        return {"status": "OK", "event": event}
+    branch = push.ref[len("refs/heads/") :]
+    await redeployer.push(
+        push.repository.owner.login,
+        push.repository.name,
+        branch,
+        push.after,
+        push.repository.default_branch,
+    )
+    return {"status": "OK", "event": event, "branch": branch, "sha": push.after}
+
+
+@app.get("/api/redeploys")
+async def get_redeploys():
+    """Debounced, running and recent push redeploys"""
+    return redeployer.stats()
\ No newline at end of file
@@ -1,11 +1,84 @@
+import asyncio
+import fcntl
 import os
-
-import jinja2
+import shutil
+from functools import lru_cache
+from typing import Optional as O
 
 from .client import client
-from .config import CLOUDFLARE_HEADERS, env
+from .config import CLOUDFLARE_HEADERS, CLOUDFLARE_URL, env
+from .idle import idle_manager
+from .locks import file_lock
+from .tracing import tracer
+
+
+@lru_cache(maxsize=None)
+def template_env():
+    """Jinja environment, jinja2 is imported on the first render.
+
+    Compiled bytecode is cached in `TEMPLATE_CACHE_DIR`, so templates are only
+    compiled from source once across restarts, and each process keeps them
+    in memory without checking the files again.
+    """
+    import jinja2  # pylint: disable=import-outside-toplevel
+
+    os.makedirs(env.TEMPLATE_CACHE_DIR, exist_ok=True)
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader("templates"),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(env.TEMPLATE_CACHE_DIR),
+        auto_reload=False,
+    )
+
+
+def get_template(name: str):
+    """Compiled template by file name"""
+    return template_env().get_template(name)
+
+
+CODESERVER_TEMPLATE_DIR = "./.vscode/.template"
+
+FICLONE = 0x40049409  # linux/fs.h, copy-on-write clone of a whole file
+
 
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader("templates"))
+def render_codeserver_template(template_dir: str = CODESERVER_TEMPLATE_DIR):
+    """Render the code-server config skeleton that user volumes are cloned from"""
+    os.makedirs(f"{template_dir}/config/workspace", exist_ok=True)
+    os.makedirs(f"{template_dir}/config/extensions", exist_ok=True)
+    code_server_settings = get_template("settings.json").render()
+    with open(
+        f"{template_dir}/config/extensions/settings.json", "w", encoding="utf-8"
+    ) as f:
+        f.write(code_server_settings)
+
+
+def clone_file(src: str, dst: str):
+    """Copy a file as a reflink when the filesystem supports it, else byte by byte"""
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def clone_tree(src: str, dst: str):
+    """Clone a directory tree, leaving files that already exist on the target untouched"""
+    for root, _, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for file_name in files:
+            dst_file = os.path.join(target, file_name)
+            if not os.path.exists(dst_file):
+                clone_file(os.path.join(root, file_name), dst_file)
+
+
+async def prepare_codeserver_volume(user: str):
+    """Populate ./.vscode/{user} from the pre-rendered template without blocking the loop"""
+    loop = asyncio.get_running_loop()
+    if not os.path.isdir(CODESERVER_TEMPLATE_DIR):
+        await loop.run_in_executor(None, render_codeserver_template)
+    await loop.run_in_executor(
+        None, clone_tree, CODESERVER_TEMPLATE_DIR, f"./.vscode/{user}"
+    )
 
 
 
@@ -20,29 +93,43 @@ async def create_dns_record(name: str):
     }
 
     return await client.fetch(
-        f"https://api.cloudflare.com/client/v4/zones/{env.CF_ZONE_ID}/dns_records",
+        f"{CLOUDFLARE_URL}/zones/{env.CF_ZONE_ID}/dns_records",
         "POST",
         headers=CLOUDFLARE_HEADERS,
         data=payload,
     )
 
 
-async def provision_instance(name:str,port:int):
-    dns_data = await create_dns_record(name)
-    template = jinja_env.get_template("nginx.conf")
-    nginx_config = template.render(name=name, port=port)
-    for path in [
-            "/etc/nginx/conf.d",
-            "/etc/nginx/sites-available",
-            "/etc/nginx/sites-enabled"
-        ]:
+def write_nginx_config(name: str, nginx_config: str):
+    """Write a site config and reload nginx, serialized across workers"""
+    with file_lock("nginx"):
+        for path in env.NGINX_CONF_DIRS:
             try:
                 os.remove(f"{path}/{name}.conf")
             except: # pylint: disable=bare-except
                 pass # pylint: disable=unnecessary-pass
             with open(f"{path}/{name}.conf", "w", encoding="utf-8") as f:
                 f.write(nginx_config)
-    os.system("nginx -s reload")
+        os.system(env.NGINX_RELOAD_CMD)
+
+
+async def route_instance(name:str,port:int,container:O[str]=None):
+    """Point the nginx site for `name` at `port`"""
+    with tracer.span("provision.nginx", name=name, port=port):
+        template = get_template("nginx.conf")
+        nginx_config = template.render(
+            name=name, port=port, log_dir=env.NGINX_LOG_DIR, wake_url=env.WAKE_URL
+        )
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, write_nginx_config, name, nginx_config)
+    if container is not None:
+        await idle_manager.register(name, container, port)
+
+
+async def provision_instance(name:str,port:int,container:O[str]=None):
+    with tracer.span("provision.dns", name=name):
+        dns_data = await create_dns_record(name)
+    await route_instance(name, port, container)
     return {
         "url": f"{name}.smartpro.solutions",
         "port": port,
@@ -0,0 +1,165 @@
+"""
+
+Scale-to-zero for idle containers, with wake on the next request
+
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Any as A
+from typing import Dict as D
+from typing import Optional as O
+
+from kubectl.client import client
+from kubectl.config import DOCKER_URL, env
+from kubectl.containers import container_index
+from kubectl.locks import file_lock, try_lock
+
+
+class IdleManager:
+    """
+
+    Stops containers whose nginx site has been idle for `IDLE_TIMEOUT`
+    seconds and starts them again on demand.
+
+    Activity is the mtime of the per-site access log nginx writes, so
+    tracking costs one `stat` per site and check. Sites are registered with
+    their container and host port in a JSON file shared by every worker; one
+    worker, elected through a lock, runs the idle checks. When a stopped
+    container gets a request, nginx hands it to `/api/wake/{site}`, which
+    starts the container, holds the request until the app answers HTTP on its
+    port, or Docker reports it healthy, and then redirects it back.
+
+    Websocket and other long-lived connections are only logged when they
+    close, so an open session looks idle. Scale-to-zero is therefore off
+    unless `IDLE_TIMEOUT` is set.
+
+    """
+
+    def __init__(self):
+        self._wakes: D[str, asyncio.Future] = {}
+        self._task: O[asyncio.Task] = None
+        self.stopped = 0
+        self.woken = 0
+
+    def load(self) -> D[str, D[str, A]]:
+        """Registered sites"""
+        try:
+            with open(env.IDLE_STATE_PATH, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _update(self, site: str, entry: O[D[str, A]]):
+        with file_lock("idle-state"):
+            sites = self.load()
+            if entry is None:
+                sites.pop(site, None)
+            else:
+                sites[site] = entry
+            tmp = f"{env.IDLE_STATE_PATH}.{os.getpid()}"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(sites, f)
+            os.replace(tmp, env.IDLE_STATE_PATH)
+
+    async def register(self, site: str, container: str, port: int):
+        """Put a site under idle management"""
+        entry = {"container": container, "port": port, "registered": time.time()}
+        await asyncio.get_running_loop().run_in_executor(None, self._update, site, entry)
+
+    async def unregister(self, site: str):
+        """Stop managing a site"""
+        await asyncio.get_running_loop().run_in_executor(None, self._update, site, None)
+
+    def last_activity(self, site: str, entry: D[str, A]) -> float:
+        """Last request to the site, or its registration time"""
+        try:
+            return os.stat(os.path.join(env.NGINX_LOG_DIR, f"{site}.access.log")).st_mtime
+        except OSError:
+            return entry.get("registered", 0.0)
+
+    async def check(self):
+        """Stop every running container whose sites have all been idle long enough"""
+        now = time.time()
+        sites = self.load()
+        active: D[str, bool] = {}
+        for site, entry in sites.items():
+            idle = now - self.last_activity(site, entry) > env.IDLE_TIMEOUT
+            active[entry["container"]] = active.get(entry["container"], False) or not idle
+        for container, busy in active.items():
+            record = container_index.get(container)
+            if busy or record is None or record.state != "running":
+                continue
+            await client.text(f"{DOCKER_URL}/containers/{record.id}/stop", "POST")
+            self.stopped += 1
+
+    async def _wake(self, site: str) -> bool:
+        entry = self.load().get(site)
+        if entry is None:
+            return False
+        deadline = time.monotonic() + env.IDLE_WAKE_TIMEOUT
+        record = container_index.get(entry["container"])
+        if record is None or record.state != "running":
+            await client.text(f"{DOCKER_URL}/containers/{entry['container']}/start", "POST")
+            self.woken += 1
+        return await container_index.wait_healthy(
+            entry["container"], entry["port"], deadline - time.monotonic()
+        )
+
+    async def wake(self, site: str) -> bool:
+        """Start the site's container and wait until it serves requests.
+
+        Concurrent wakes of the same site share one start.
+        """
+        task = self._wakes.get(site)
+        if task is None:
+            task = self._wakes[site] = asyncio.ensure_future(self._wake(site))
+            task.add_done_callback(lambda _: self._wakes.pop(site, None))
+        return await asyncio.shield(task)
+
+    async def run(self):
+        """Run idle checks while this worker holds the idle lock"""
+        fd = None
+        while True:
+            try:
+                if fd is None:
+                    fd = try_lock("idle")
+                if fd is not None:
+                    await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                pass
+            await asyncio.sleep(env.IDLE_CHECK_INTERVAL)
+
+    def start(self):
+        """Start the background checks, unless scale-to-zero is disabled"""
+        if env.IDLE_TIMEOUT > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """Stop the background checks"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> D[str, A]:
+        """Managed sites with their idle time"""
+        now = time.time()
+        sites = self.load()
+        return {
+            "stopped": self.stopped,
+            "woken": self.woken,
+            "sites": {
+                site: {**entry, "idle_s": round(now - self.last_activity(site, entry), 1)}
+                for site, entry in sites.items()
+            },
+        }
+
+
+idle_manager = IdleManager()
@@ -0,0 +1,80 @@
+"""
+
+Cross-process coordination through file locks
+
+"""
+import asyncio
+import fcntl
+import os
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any as A
+from typing import Awaitable, Callable
+from typing import Optional as O
+from uuid import uuid4
+
+from kubectl.config import env
+
+# Shared by every worker forked from the same supervisor, unique otherwise
+BOOT_ID = os.environ.setdefault("KUBECTL_BOOT_ID", uuid4().hex)
+
+
+def lock_path(name: str) -> str:
+    """Path of the lock file for `name`"""
+    os.makedirs(env.LOCK_DIR, exist_ok=True)
+    return os.path.join(env.LOCK_DIR, f"{name}.lock")
+
+
+@contextmanager
+def file_lock(name: str):
+    """Hold an exclusive `flock` on the lock file for `name`"""
+    fd = os.open(lock_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def try_lock(name: str) -> O[int]:
+    """Take the lock for `name` without blocking, for as long as this process lives.
+
+    Returns the locked descriptor, or None when another process holds it.
+    """
+    fd = os.open(lock_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+@asynccontextmanager
+async def async_file_lock(name: str):
+    """`file_lock` acquired off the event loop"""
+    fd = os.open(lock_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, fcntl.flock, fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+async def run_once(name: str, func: Callable[[], Awaitable[A]]) -> bool:
+    """Run `func` in exactly one worker per boot, the others wait for it to finish.
+
+    Returns whether this worker ran it.
+    """
+    marker = os.path.join(env.LOCK_DIR, f"{name}.{BOOT_ID}.done")
+    async with async_file_lock(name):
+        if os.path.exists(marker):
+            return False
+        await func()
+        for stale in os.listdir(env.LOCK_DIR):
+            if stale.startswith(f"{name}.") and stale.endswith(".done"):
+                os.remove(os.path.join(env.LOCK_DIR, stale))
+        with open(marker, "w", encoding="utf-8") as f:
+            f.write(str(os.getpid()))
+        return True
@@ -3,25 +3,18 @@
 AioFauna Models
 
 """
-import os
 from datetime import datetime
-from random import randint
 from typing import List as L
 from typing import Optional as O
 
-import jinja2
-from aioboto3 import Session
 from aiofauna import FaunaModel as Q
 from aiofauna import Field
-from names import get_full_name
-from pydantic import BaseModel  # pylint: disable=no-name-in-module
+from pydantic import BaseModel, PrivateAttr  # pylint: disable=no-name-in-module
 
-from kubectl.helpers import jinja_env
+from kubectl.helpers import prepare_codeserver_volume
 from kubectl.payload import RepoDeployPayload
 from kubectl.utils import gen_port
 
-session = Session()
-
 
 class Upload(Q):
     """
@@ -91,48 +84,54 @@ class CodeServer(Q):
     proxy_port: O[int] = Field(default_factory=gen_port, description="Proxy port")
     env_vars: O[L[str]] = Field(default=[], description="Environment variables")
     
+    _payload: O[dict] = PrivateAttr(default=None)
+
     @property
     def payload(self):
         """
 
-        Payload
+        Payload, built once per instance
 
         """
-        assert isinstance(self.env_vars, list)
-        self.env_vars.append(f"PASSWORD={self.user}")
-        self.env_vars.append("TZ=America/New_York")
-        self.env_vars.append(f"PUID={self.user}")
-        self.env_vars.append(f"PGID={self.user}")
-        self.env_vars.append(f"USER={self.user}")
-        self.env_vars.append(f"PROXY_DOMAIN={self.user}.smartpro.solutions")
-        self.env_vars.append(f"SUDO_PASSWORD={self.user}")
-        
-        os.makedirs(f"./.vscode/{self.user}/config/workspace", exist_ok=True)
-        os.makedirs(f"./.vscode/{self.user}/config/extensions", exist_ok=True)        
-        
-        code_server_settings = jinja_env.get_template("settings.json").render()
-        
-        with open(f"./.vscode/{self.user}/config/extensions/settings.json", "w") as f:
-            f.write(code_server_settings)
-        
-        return {
-            "Image": self.image,
-            "Env": self.env_vars,
-            "ExposedPorts": {"8443/tcp": {"HostPort": str(self.port)}},
-            "HostConfig": {
-                "PortBindings": {"8443/tcp": [{"HostPort": str(self.port)}],
-                                 "8080/tcp": [{"HostPort": str(self.proxy_port)}]},
-            },
-            "Volumes": {f"./.vscode/{self.user}/config/workspace": {
-                "bind": "/config/workspace",
-                "mode": "rw"
-            },
-            f"./.vscode/{self.user}/config/extensions": {
-                "bind": "/config/extensions",
-                "mode": "rw"
+        if self._payload is None:
+            assert isinstance(self.env_vars, list)
+            env_vars = [
+                *self.env_vars,
+                f"PASSWORD={self.user}",
+                "TZ=America/New_York",
+                f"PUID={self.user}",
+                f"PGID={self.user}",
+                f"USER={self.user}",
+                f"PROXY_DOMAIN={self.user}.smartpro.solutions",
+                f"SUDO_PASSWORD={self.user}",
+            ]
+            self._payload = {
+                "Image": self.image,
+                "Env": env_vars,
+                "ExposedPorts": {"8443/tcp": {"HostPort": str(self.port)}},
+                "HostConfig": {
+                    "PortBindings": {"8443/tcp": [{"HostPort": str(self.port)}],
+                                     "8080/tcp": [{"HostPort": str(self.proxy_port)}]},
+                },
+                "Volumes": {f"./.vscode/{self.user}/config/workspace": {
+                    "bind": "/config/workspace",
+                    "mode": "rw"
+                },
+                f"./.vscode/{self.user}/config/extensions": {
+                    "bind": "/config/extensions",
+                    "mode": "rw"
+                }
             }
-        }
-        }
+            }
+        return self._payload
+
+    async def prepare_volumes(self):
+        """
+
+        Clone the config volumes from the pre-rendered template
+
+        """
+        await prepare_codeserver_volume(self.user)
 
 
 
@@ -177,4 +176,9 @@ class Container(Q):
     url: O[str] = Field(None, description="Container url")
     data: O[dict] = Field(None, description="Container data")
     repo_payload: O[RepoDeployPayload] = Field(None, description="Repo payload")
+    branch: O[str] = Field(None, description="Tracked branch, the default branch if unset")
+    sha: O[str] = Field(None, description="Deployed commit")
+    image: O[str] = Field(None, description="Deployed image")
+    container_id: O[str] = Field(None, description="Docker container currently serving the site")
+    port: O[int] = Field(None, description="Host port currently serving the site")
     
\ No newline at end of file
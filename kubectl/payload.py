@@ -8,7 +8,6 @@ from typing import List as L  # pylint: disable=unused-import
 from typing import Literal
 from typing import Optional as O
 
-from boto3.docs import action
 from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module
 
 from kubectl.utils import gen_oid, gen_port
@@ -36,6 +35,68 @@ class RepoDeployPayload(BaseModel):
     
     env_vars: O[L[str]] = Field(default=["DOCKER=1"], description="Environment variables")
     port:int=Field(default=8080, description="Port to expose")
+
+    def container_config(self, image: str, host_port: int) -> dict:
+        """Docker create payload running `image` with `port` published on `host_port`"""
+        return {
+            "Image": image,
+            "Env": self.env_vars,
+            "ExposedPorts": {f"{self.port}/tcp": {"HostPort": str(host_port)}},
+            "HostConfig": {"PortBindings": {f"{self.port}/tcp": [{"HostPort": str(host_port)}]}},
+        }
     
-class GithubWebhookPayload(BaseModel):
-    ...
\ No newline at end of file
+class BatchDeployItem(BaseModel):
+    """
+
+    Single repository of a batch deploy
+
+    """
+
+    owner: str = Field(..., description="Repository owner")
+    repo: str = Field(..., description="Repository name")
+    payload: RepoDeployPayload = Field(default_factory=RepoDeployPayload, description="Deploy payload")
+
+
+class BatchDeployPayload(BaseModel):
+    """
+
+    Batch deploy payload
+
+    """
+
+    items: L[BatchDeployItem] = Field(..., description="Repositories to deploy")
+    concurrency: O[int] = Field(default=None, gt=0, description="Deploys to run at once, capped by DEPLOY_CONCURRENCY")
+
+class GithubOwner(BaseModel):
+    """
+
+    Github repository owner
+
+    """
+
+    login: str = Field(..., description="Owner login")
+
+
+class GithubRepository(BaseModel):
+    """
+
+    Github repository, as embedded in webhook events
+
+    """
+
+    name: str = Field(..., description="Repository name")
+    owner: GithubOwner = Field(..., description="Repository owner")
+    default_branch: str = Field("main", description="Default branch")
+
+
+class GithubPushPayload(BaseModel):
+    """
+
+    Github push event
+
+    """
+
+    ref: str = Field(..., description="Pushed ref, e.g. refs/heads/main")
+    after: str = Field(..., description="Commit the ref points to after the push")
+    deleted: bool = Field(False, description="Whether the push deleted the ref")
+    repository: GithubRepository = Field(..., description="Pushed repository")
\ No newline at end of file
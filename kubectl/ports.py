@@ -0,0 +1,122 @@
+"""
+
+Host port allocator backed by a persisted lease bitmap
+
+"""
+import fcntl
+import mmap
+import os
+import re
+from contextlib import contextmanager
+from typing import Iterable
+from typing import Optional as O
+
+from kubectl.config import env
+
+FREE_BYTE = re.compile(rb"[^\xff]")
+
+
+class PortAllocator:
+    """
+
+    Leases host ports out of [start, end) using one bit per port.
+
+    The bitmap lives in a memory mapped file guarded by `flock`, so leases
+    survive restarts and every worker on the host sees the same table.
+
+    """
+
+    def __init__(self, path: str, start: int, end: int):
+        if not 0 < start < end <= 65536:
+            raise ValueError("Invalid port range")
+        self.path = path
+        self.start = start
+        self.end = end
+        self.size = (end - start + 7) // 8
+        self._fd: O[int] = None
+        self._map: O[mmap.mmap] = None
+        self._pid: O[int] = None
+        self._cursor = 0
+
+    @property
+    def bitmap(self) -> mmap.mmap:
+        """Map the lease file, creating it on first use"""
+        # A forked worker must not share the parent's open file: flock would not
+        # tell them apart
+        if self._map is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(self._fd).st_size < self.size:
+                os.ftruncate(self._fd, self.size)
+            self._map = mmap.mmap(self._fd, self.size)
+        return self._map
+
+    @contextmanager
+    def _locked(self):
+        bitmap = self.bitmap
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield bitmap
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _index(self, port: int) -> O[int]:
+        if self.start <= port < self.end:
+            return port - self.start
+        return None
+
+    def allocate(self) -> int:
+        """Lease the next free port"""
+        with self._locked() as bitmap:
+            for lo, hi in ((self._cursor, self.size), (0, self._cursor)):
+                match = FREE_BYTE.search(bitmap, lo, hi)
+                if match is None:
+                    continue
+                byte_index = match.start()
+                byte = bitmap[byte_index]
+                bit = (~byte & (byte + 1)).bit_length() - 1
+                index = byte_index * 8 + bit
+                if self.start + index < self.end:
+                    bitmap[byte_index] = byte | (1 << bit)
+                    self._cursor = byte_index
+                    return self.start + index
+        raise RuntimeError(f"No free ports left in {self.start}-{self.end}")
+
+    def reserve(self, port: int) -> bool:
+        """Lease a specific port, False if it is taken or out of range"""
+        index = self._index(port)
+        if index is None:
+            return False
+        with self._locked() as bitmap:
+            byte = bitmap[index // 8]
+            if byte & (1 << index % 8):
+                return False
+            bitmap[index // 8] = byte | (1 << index % 8)
+            return True
+
+    def release(self, port: int):
+        """Return a port to the pool"""
+        index = self._index(port)
+        if index is None:
+            return
+        with self._locked() as bitmap:
+            bitmap[index // 8] &= ~(1 << index % 8) & 0xFF
+
+    def rebuild(self, ports: Iterable[int]):
+        """Replace every lease with exactly `ports`, dropping leases nothing holds anymore"""
+        with self._locked() as bitmap:
+            bitmap[:] = bytes(self.size)
+            for port in ports:
+                index = self._index(port)
+                if index is not None:
+                    bitmap[index // 8] |= 1 << index % 8
+
+    def leased(self, port: int) -> bool:
+        """Check whether a port is currently leased"""
+        index = self._index(port)
+        if index is None:
+            return False
+        return bool(self.bitmap[index // 8] & (1 << index % 8))
+
+
+port_allocator = PortAllocator(env.PORT_LEASES_PATH, env.PORT_RANGE_START, env.PORT_RANGE_END)
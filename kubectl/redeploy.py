@@ -0,0 +1,197 @@
+"""
+
+Push-driven rolling redeploys
+
+"""
+import asyncio
+import json
+import time
+from typing import Any as A
+from typing import Dict as D
+from typing import List as L
+from typing import Tuple
+
+from kubectl.client import client
+from kubectl.config import DOCKER_URL, env
+from kubectl.containers import container_index
+from kubectl.decorators import get_redis
+from kubectl.helpers import route_instance
+from kubectl.locks import async_file_lock
+from kubectl.models import Container
+from kubectl.payload import RepoDeployPayload
+from kubectl.ports import port_allocator
+from kubectl.tracing import tracer
+
+Key = Tuple[str, str, str]
+
+
+class Redeployer:
+    """
+
+    Rebuilds the containers of a repository branch when GitHub reports a push.
+
+    Pushes are debounced per branch: every push restarts a `REDEPLOY_DEBOUNCE`
+    second timer and only the last commit of the burst is built, once, for
+    every container tracking the branch. Containers already running that
+    commit are left alone. Each container is replaced without downtime: the
+    new one is started on a fresh port, nginx is switched once it serves
+    requests, and the old one is removed after `REDEPLOY_DRAIN` seconds.
+
+    Pushes of one burst can reach different workers, each with its own
+    timer. The last pushed commit of a branch is kept in Redis, and rollouts
+    of a branch run under a lock shared by the workers and re-read the
+    records, so a commit is built and rolled out once whichever timer fires.
+
+    """
+
+    def __init__(self):
+        self.pending: D[Key, Tuple[str, str]] = {}
+        self.ready: D[Key, Tuple[str, str]] = {}
+        self.timers: D[Key, asyncio.TimerHandle] = {}
+        self.running: D[Key, asyncio.Task] = {}
+        self.history: L[D[str, A]] = []
+        self.merged = 0
+
+    @staticmethod
+    def latest_key(key: Key) -> str:
+        """Redis key holding the last commit pushed to a branch"""
+        return "redeploy:{}/{}/{}".format(*key)
+
+    async def push(self, owner: str, repo: str, branch: str, sha: str, default_branch: str):
+        """Record a push, (re)starting the debounce timer of its branch"""
+        key = (owner, repo, branch)
+        try:
+            await get_redis().set(self.latest_key(key), json.dumps([sha, default_branch]), ex=86400)
+        except Exception:  # pylint: disable=broad-except
+            pass
+        if key in self.pending:
+            self.merged += 1
+        self.pending[key] = (sha, default_branch)
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self.timers[key] = asyncio.get_running_loop().call_later(
+            env.REDEPLOY_DEBOUNCE, self._fire, key
+        )
+
+    async def latest(self, key: Key, sha: str, default_branch: str) -> Tuple[str, str]:
+        """Last commit pushed to the branch through any worker, `sha` if unknown"""
+        try:
+            value = await get_redis().get(self.latest_key(key))
+        except Exception:  # pylint: disable=broad-except
+            value = None
+        if value is None:
+            return sha, default_branch
+        latest_sha, latest_default = json.loads(value)
+        return latest_sha, latest_default
+
+    def _fire(self, key: Key):
+        self.timers.pop(key, None)
+        self.ready[key] = self.pending.pop(key)
+        task = self.running.get(key)
+        if task is None or task.done():
+            self.running[key] = asyncio.ensure_future(self._drain(key))
+
+    async def _drain(self, key: Key):
+        """Deploy the latest settled commit of a branch, one rollout at a time"""
+        while key in self.ready:
+            sha, default_branch = self.ready.pop(key)
+            owner, repo, branch = key
+            entry: D[str, A] = {"owner": owner, "repo": repo, "branch": branch, "sha": sha}
+            started = time.monotonic()
+            try:
+                async with async_file_lock("redeploy.{}.{}.{}".format(*key)):
+                    sha, default_branch = await self.latest(key, sha, default_branch)
+                    entry["sha"] = sha
+                    entry["containers"] = await self.redeploy(owner, repo, branch, sha, default_branch)
+                entry["status"] = "success"
+            except Exception as e:  # pylint: disable=broad-except
+                entry["status"] = "error"
+                entry["message"] = str(e)
+            entry["duration_s"] = round(time.monotonic() - started, 3)
+            self.history = [*self.history[-49:], entry]
+        self.running.pop(key, None)
+
+    async def targets(
+        self, owner: str, repo: str, branch: str, sha: str, default_branch: str
+    ) -> L[Container]:
+        """Containers tracking `branch` that do not run `sha` yet"""
+        return [
+            container
+            for container in await Container.find_many("repo", repo)
+            if container.owner == owner
+            and (container.branch or default_branch) == branch
+            and container.sha != sha
+        ]
+
+    async def redeploy(
+        self, owner: str, repo: str, branch: str, sha: str, default_branch: str
+    ) -> L[str]:
+        """Build `sha` once and roll it out to every container of the branch"""
+        from kubectl.handlers import build_image  # pylint: disable=import-outside-toplevel
+
+        containers = await self.targets(owner, repo, branch, sha, default_branch)
+        if not containers:
+            return []
+        image = await build_image(owner, repo, sha)
+        for container in containers:
+            await self.roll(container, image, sha)
+        return [container.name for container in containers]
+
+    async def roll(self, container: Container, image: str, sha: str):
+        """Replace one container with a new one running `image`.
+
+        Rolls of a site are serialized across workers and start from the
+        record as it is under the lock, so the container removed is the one
+        serving now and a commit already rolled out is not rolled again.
+        """
+        async with async_file_lock(f"roll.{container.name}"):
+            current = await Container.find_unique("name", container.name)
+            if isinstance(current, Container) and current.sha != sha:
+                await self._roll(current, image, sha)
+
+    async def _roll(self, container: Container, image: str, sha: str):
+        payload = container.repo_payload or RepoDeployPayload()
+        port = port_allocator.allocate()
+        with tracer.span("redeploy.roll", name=container.name, sha=sha):
+            try:
+                created = await client.fetch(
+                    f"{DOCKER_URL}/containers/create?name={container.name}-{sha[:7]}",
+                    "POST",
+                    headers={"Content-Type": "application/json"},
+                    data=payload.container_config(image, port),
+                )
+                assert isinstance(created, dict)
+                _id = created["Id"]
+                await client.text(f"{DOCKER_URL}/containers/{_id}/start", "POST")
+                if not await container_index.wait_healthy(_id, port, env.REDEPLOY_HEALTH_TIMEOUT):
+                    await client.text(f"{DOCKER_URL}/containers/{_id}?force=true", "DELETE")
+                    raise Exception(f"{container.name} did not become healthy on {port}")
+            except Exception:
+                port_allocator.release(port)
+                raise
+            await route_instance(container.name, port, container=_id)
+            previous = container_index.get(container.container_id or container.name)
+            await Container.update(
+                container.ref, container_id=_id, port=port, sha=sha, image=image
+            )
+            if previous is not None:
+                await asyncio.sleep(env.REDEPLOY_DRAIN)
+                await client.text(f"{DOCKER_URL}/containers/{previous.id}?force=true", "DELETE")
+                container_index.discard(previous.id)
+                for old_port in previous.ports:
+                    port_allocator.release(old_port)
+            elif container.port:
+                port_allocator.release(container.port)
+
+    def stats(self) -> D[str, A]:
+        """Debounced, running and recent redeploys"""
+        return {
+            "debouncing": [list(key) for key in self.pending],
+            "running": [list(key) for key, task in self.running.items() if not task.done()],
+            "merged": self.merged,
+            "recent": self.history[-10:],
+        }
+
+
+redeployer = Redeployer()
@@ -0,0 +1,227 @@
+"""
+
+Parallel, incremental directory scanning
+
+"""
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any as A
+from typing import AsyncGenerator as AG
+from typing import Dict as D
+from typing import Iterator as I
+from typing import List as L
+from typing import NamedTuple
+from typing import Optional as O
+
+SNIFF_BYTES = 8192
+
+
+class DirEntry(NamedTuple):
+    """Cached listing of a single directory"""
+
+    mtime_ns: int
+    files_size: int
+    subdirs: L[str]
+
+
+def is_binary(path: str) -> bool:
+    """Sniff the first bytes of a file to tell binary from text"""
+    try:
+        with open(path, "rb") as file_:
+            chunk = file_.read(SNIFF_BYTES)
+    except OSError:
+        return True
+    if b"\0" in chunk:
+        return True
+    try:
+        chunk.decode("utf-8")
+    except UnicodeDecodeError as exc:
+        # A multibyte character cut at the sniff boundary is still text
+        return not (len(chunk) == SNIFF_BYTES and exc.start >= len(chunk) - 3)
+    return False
+
+
+class DirScanner:
+    """
+
+    Scans directory trees with `os.scandir` fanned out over a thread pool.
+
+    Per-directory listings are cached against the directory mtime, so a
+    rescan only lists directories whose entries changed. A file rewritten in
+    place does not bump its directory mtime, so its size may lag until an
+    entry of that directory is added, removed or renamed.
+
+    At most `max_cached` listings are kept, least recently used first out, so
+    scanning many volumes does not grow the cache without bound.
+
+    """
+
+    def __init__(self, workers: int = 8, max_cached: int = 50000):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan")
+        self.max_cached = max_cached
+        self._cache: "OrderedDict[str, DirEntry]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _cached(self, path: str, mtime_ns: int) -> O[DirEntry]:
+        with self._cache_lock:
+            cached = self._cache.get(path)
+            if cached is None or cached.mtime_ns != mtime_ns:
+                return None
+            self._cache.move_to_end(path)
+            return cached
+
+    def _store(self, path: str, listing: DirEntry):
+        with self._cache_lock:
+            self._cache[path] = listing
+            self._cache.move_to_end(path)
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+
+    def _list(self, path: str) -> DirEntry:
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return DirEntry(0, 0, [])
+        cached = self._cached(path, mtime_ns)
+        if cached is not None:
+            return cached
+        files_size = 0
+        subdirs = []
+        try:
+            with os.scandir(path) as it_:
+                for entry in it_:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            files_size += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        listing = DirEntry(mtime_ns, files_size, subdirs)
+        self._store(path, listing)
+        return listing
+
+    def dir_size(self, path: str = ".") -> int:
+        """Total size in bytes of the files below `path`"""
+        total = 0
+        frontier = [os.path.normpath(path)]
+        while frontier:
+            listings = list(self.pool.map(self._list, frontier))
+            total += sum(listing.files_size for listing in listings)
+            frontier = [subdir for listing in listings for subdir in listing.subdirs]
+        return total
+
+    def _children(self, path: str) -> L[os.DirEntry]:
+        try:
+            with os.scandir(path) as it_:
+                return sorted(it_, key=lambda entry: entry.name)
+        except OSError:
+            return []
+
+    def iter_tree(
+        self,
+        root_dir: str,
+        max_depth: int = 8,
+        max_entries: int = 10000,
+        max_file_bytes: int = 64 * 1024,
+        content: bool = False,
+    ) -> I[D[str, A]]:
+        """Lazily yield the nodes below `root_dir`, breadth first.
+
+        Directories of the same level are listed in parallel. Files are only
+        opened when `content` is set: they are then sniffed for `binary`, and
+        read when text that fits in `max_file_bytes`. A final `truncated` node is yielded when a limit cuts
+        the walk short.
+        """
+        root_dir = os.path.normpath(root_dir)
+        emitted = 0
+        frontier = [root_dir]
+        depth = 1
+        while frontier and depth <= max_depth:
+            next_frontier = []
+            for entries in self.pool.map(self._children, frontier):
+                for entry in entries:
+                    if emitted >= max_entries:
+                        yield {"type": "truncated", "reason": "max_entries"}
+                        return
+                    node = self._node(entry, root_dir, depth, max_file_bytes, content)
+                    if node["type"] == "directory":
+                        next_frontier.append(entry.path)
+                    emitted += 1
+                    yield node
+            frontier = next_frontier
+            depth += 1
+        if frontier:
+            yield {"type": "truncated", "reason": "max_depth"}
+
+    def _node(
+        self,
+        entry: os.DirEntry,
+        root_dir: str,
+        depth: int,
+        max_file_bytes: int,
+        content: bool,
+    ) -> D[str, A]:
+        node: D[str, A] = {
+            "name": entry.name,
+            "path": os.path.relpath(entry.path, root_dir),
+            "depth": depth,
+        }
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                node["type"] = "directory"
+                return node
+            size = entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            node["type"] = "file"
+            return node
+        node["type"] = "file"
+        node["size"] = size
+        if not content:
+            return node
+        node["binary"] = is_binary(entry.path)
+        if not node["binary"]:
+            if size <= max_file_bytes:
+                try:
+                    with open(entry.path, "r", encoding="utf-8", errors="replace") as file_:
+                        node["content"] = file_.read()
+                except OSError:
+                    # Removed or permissions changed since it was listed
+                    node["unreadable"] = True
+            else:
+                node["truncated"] = True
+        return node
+
+    async def adir_size(self, path: str = ".") -> int:
+        """`dir_size` without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.dir_size, path)
+
+    async def aiter_tree(self, root_dir: str, batch: int = 256, **kwargs) -> AG[L[D[str, A]], None]:
+        """Stream `iter_tree` in batches without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        nodes = self.iter_tree(root_dir, **kwargs)
+        while True:
+            chunk = await loop.run_in_executor(None, lambda: list(islice(nodes, batch)))
+            if not chunk:
+                return
+            yield chunk
+
+    def invalidate(self, path: O[str] = None):
+        """Drop cached listings below `path`, or all of them"""
+        with self._cache_lock:
+            if path is None:
+                self._cache.clear()
+                return
+            path = os.path.normpath(path)
+            for key in [k for k in self._cache if k == path or k.startswith(path + os.sep)]:
+                del self._cache[key]
+
+
+scanner = DirScanner()
@@ -0,0 +1,44 @@
+"""
+
+S3 bucket access, loading aioboto3 on first use
+
+"""
+from typing import Any as A
+
+from kubectl.config import env
+
+
+class Storage:
+    """
+
+    Uploads bucket. aioboto3 and botocore take a large share of cold start,
+    so they are imported and the session is built on the first upload.
+
+    """
+
+    def __init__(self):
+        self._session: A = None
+
+    @property
+    def session(self):
+        """aioboto3 session, created lazily"""
+        if self._session is None:
+            from aioboto3 import Session  # pylint: disable=import-outside-toplevel
+
+            self._session = Session()
+        return self._session
+
+    def client(self):
+        """Async context manager yielding an S3 client for the bucket endpoint"""
+        from botocore.config import Config  # pylint: disable=import-outside-toplevel
+
+        return self.session.client(
+            service_name="s3",
+            aws_access_key_id=env.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=env.AWS_SECRET_ACCESS_KEY,
+            endpoint_url=env.AWS_S3_ENDPOINT,
+            config=Config(signature_version="s3v4"),
+        )
+
+
+storage = Storage()
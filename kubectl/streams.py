@@ -0,0 +1,209 @@
+"""
+
+Fan-out of Docker stats and logs streams
+
+"""
+import asyncio
+import json
+import struct
+from collections import deque
+from typing import Any as A
+from typing import Dict as D
+from typing import Iterator as I
+from typing import List as L
+from typing import Optional as O
+from typing import Set, Tuple
+
+from aiohttp import ClientSession, ClientTimeout
+
+from kubectl.config import DOCKER_URL, env
+
+LOG_STREAMS = {0: "stdin", 1: "stdout", 2: "stderr"}
+
+
+def condense_stats(stats: D[str, A]) -> D[str, A]:
+    """Reduce a Docker stats sample to what dashboards plot"""
+    cpu = stats.get("cpu_stats", {})
+    precpu = stats.get("precpu_stats", {})
+    cpu_delta = cpu.get("cpu_usage", {}).get("total_usage", 0) - precpu.get("cpu_usage", {}).get("total_usage", 0)
+    system_delta = cpu.get("system_cpu_usage", 0) - precpu.get("system_cpu_usage", 0)
+    cpus = cpu.get("online_cpus") or len(cpu.get("cpu_usage", {}).get("percpu_usage") or []) or 1
+    networks = stats.get("networks", {}).values()
+    memory = stats.get("memory_stats", {})
+    return {
+        "read": stats.get("read"),
+        "cpu_percent": round(cpu_delta / system_delta * cpus * 100, 2) if system_delta > 0 else 0.0,
+        "memory_usage": memory.get("usage"),
+        "memory_limit": memory.get("limit"),
+        "rx_bytes": sum(n.get("rx_bytes", 0) for n in networks),
+        "tx_bytes": sum(n.get("tx_bytes", 0) for n in networks),
+        "pids": stats.get("pids_stats", {}).get("current"),
+    }
+
+
+class LogDemuxer:
+    """
+
+    Splits Docker's multiplexed log stream (8 byte frame headers) into lines.
+    Containers running with a TTY send raw bytes, which are detected from the
+    first chunk and passed through as stdout.
+
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.raw: O[bool] = None
+        self.partial: D[str, str] = {}
+
+    def feed(self, chunk: bytes) -> I[D[str, str]]:
+        """Yield every complete line found in `chunk`"""
+        self.buffer += chunk
+        if self.raw is None and len(self.buffer) >= 8:
+            self.raw = not (self.buffer[0] in LOG_STREAMS and self.buffer[1:4] == b"\0\0\0")
+        if self.raw is None:
+            return
+        if self.raw:
+            data, self.buffer = self.buffer, b""
+            yield from self._lines("stdout", data)
+            return
+        while len(self.buffer) >= 8:
+            kind, size = struct.unpack(">BxxxL", self.buffer[:8])
+            if len(self.buffer) < 8 + size:
+                break
+            data, self.buffer = self.buffer[8 : 8 + size], self.buffer[8 + size :]
+            yield from self._lines(LOG_STREAMS.get(kind, "stdout"), data)
+
+    def _lines(self, stream: str, data: bytes) -> I[D[str, str]]:
+        text = self.partial.pop(stream, "") + data.decode("utf-8", errors="replace")
+        *lines, rest = text.split("\n")
+        if rest:
+            self.partial[stream] = rest
+        for line in lines:
+            yield {"stream": stream, "line": line}
+
+
+class Channel:
+    """
+
+    One upstream Docker stream shared by every subscriber of a container.
+
+    Each subscriber gets its own bounded queue: a slow consumer loses its
+    oldest items instead of stalling the upstream or the other subscribers.
+    Recent items are kept in a ring buffer and replayed to new subscribers.
+
+    """
+
+    def __init__(self, hub: "StreamHub", kind: str, container_id: str):
+        self.hub = hub
+        self.kind = kind
+        self.container_id = container_id
+        self.history: "deque[D[str, A]]" = deque(maxlen=env.LOG_HISTORY if kind == "logs" else 1)
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.dropped = 0
+        self.task: O[asyncio.Task] = None
+        self.linger: O[asyncio.TimerHandle] = None
+
+    def subscribe(self) -> asyncio.Queue:
+        """Register a subscriber, replaying the ring buffer into its queue"""
+        if self.linger is not None:
+            self.linger.cancel()
+            self.linger = None
+        queue: asyncio.Queue = asyncio.Queue(maxsize=env.STREAM_QUEUE_SIZE)
+        for item in list(self.history)[-env.STREAM_QUEUE_SIZE :]:
+            queue.put_nowait(item)
+        self.subscribers.add(queue)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        """Drop a subscriber, closing the upstream after a grace period once nobody listens"""
+        self.subscribers.discard(queue)
+        if not self.subscribers and self.linger is None:
+            self.linger = asyncio.get_running_loop().call_later(env.STREAM_LINGER, self.close)
+
+    def close(self):
+        """Stop the upstream stream and forget the channel"""
+        if self.subscribers:
+            return
+        if self.task is not None:
+            self.task.cancel()
+        self.hub.channels.pop((self.kind, self.container_id), None)
+
+    def publish(self, item: D[str, A]):
+        """Append to the ring buffer and hand the item to every subscriber"""
+        self.history.append(item)
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(item)
+
+    def url(self, resumed: bool) -> str:
+        """Docker endpoint for this channel"""
+        if self.kind == "stats":
+            return f"{DOCKER_URL}/containers/{self.container_id}/stats?stream=true"
+        tail = 0 if resumed else env.LOG_HISTORY
+        return f"{DOCKER_URL}/containers/{self.container_id}/logs?follow=true&stdout=true&stderr=true&tail={tail}"
+
+    async def run(self):
+        """Read the upstream stream, reconnecting while anyone is subscribed"""
+        resumed = False
+        while self.subscribers:
+            try:
+                async with ClientSession(timeout=ClientTimeout(total=None)) as session:
+                    async with session.get(self.url(resumed)) as response:
+                        if response.status != 200:
+                            self.publish({"error": await response.text(), "status": response.status})
+                            return
+                        if self.kind == "stats":
+                            async for line in response.content:
+                                if line.strip():
+                                    self.publish(condense_stats(json.loads(line)))
+                        else:
+                            demuxer = LogDemuxer()
+                            async for chunk in response.content.iter_any():
+                                for item in demuxer.feed(chunk):
+                                    self.publish(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                pass
+            resumed = True
+            await asyncio.sleep(1.0)
+
+
+class StreamHub:
+    """
+
+    Registry of open channels, at most one per container and stream kind
+
+    """
+
+    def __init__(self):
+        self.channels: D[Tuple[str, str], Channel] = {}
+
+    def subscribe(self, kind: str, container_id: str) -> Tuple[Channel, asyncio.Queue]:
+        """Subscribe to the `stats` or `logs` of a container"""
+        if kind not in ("stats", "logs"):
+            raise ValueError("Stream kind must be stats or logs")
+        channel = self.channels.get((kind, container_id))
+        if channel is None:
+            channel = self.channels[(kind, container_id)] = Channel(self, kind, container_id)
+        return channel, channel.subscribe()
+
+    def stats(self) -> L[D[str, A]]:
+        """Open channels with their subscriber and drop counts"""
+        return [
+            {
+                "kind": channel.kind,
+                "container": channel.container_id,
+                "subscribers": len(channel.subscribers),
+                "buffered": len(channel.history),
+                "dropped": channel.dropped,
+            }
+            for channel in self.channels.values()
+        ]
+
+
+hub = StreamHub()
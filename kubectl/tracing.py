@@ -0,0 +1,159 @@
+"""
+
+Lightweight in-process tracing
+
+"""
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any as A
+from typing import Dict as D
+from typing import Iterator as I
+from typing import List as L
+from typing import Optional as O
+from uuid import uuid4
+
+from aiohttp.web import Request, middleware
+
+from kubectl.config import env
+
+_current: ContextVar = ContextVar("span", default=None)
+
+
+class Span:
+    """
+
+    Timed operation, child of the span that was current when it started
+
+    """
+
+    __slots__ = ("trace_id", "name", "children", "attributes", "start", "end", "error")
+
+    def __init__(self, trace_id: str, name: str, attributes: D[str, A]):
+        self.trace_id = trace_id
+        self.name = name
+        self.children: L["Span"] = []
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.end: O[float] = None
+        self.error: O[str] = None
+
+    def set(self, **attributes: A):
+        """Attach attributes to the span"""
+        self.attributes.update(attributes)
+
+    @property
+    def duration(self) -> float:
+        """Duration in seconds, up to now while the span is open"""
+        return (self.end or time.perf_counter()) - self.start
+
+    def to_dict(self, origin: O[float] = None) -> D[str, A]:
+        """Span tree with offsets relative to `origin`, in milliseconds"""
+        origin = self.start if origin is None else origin
+        return {
+            "name": self.name,
+            "offset_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+            "children": [child.to_dict(origin) for child in self.children],
+        }
+
+
+class _NoopSpan:
+    """Stand-in yielded when the request is not sampled"""
+
+    def set(self, **attributes: A):
+        """Discard attributes"""
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def critical_path(root: Span) -> L[D[str, A]]:
+    """Follow the last child to finish at every level, with each step's own time"""
+    path = []
+    span: O[Span] = root
+    while span is not None:
+        children = sum(child.duration for child in span.children)
+        path.append(
+            {
+                "name": span.name,
+                "duration_ms": round(span.duration * 1000, 3),
+                "self_ms": round(max(span.duration - children, 0) * 1000, 3),
+            }
+        )
+        span = max(span.children, key=lambda child: child.end or 0, default=None)
+    return path
+
+
+class Tracer:
+    """
+
+    Samples root spans at `sample_rate` and keeps the last `capacity`
+    finished traces in a ring buffer. Outside a sampled trace `span` is a
+    no-op, so instrumentation costs one context variable lookup.
+
+    """
+
+    def __init__(self, sample_rate: float = 1.0, capacity: int = 256):
+        self.sample_rate = sample_rate
+        self.traces: "deque[Span]" = deque(maxlen=capacity)
+
+    @contextmanager
+    def span(self, span_name: str, root: bool = False, **attributes: A) -> I[A]:
+        """Open a child of the current span, or a new sampled trace when `root`.
+
+        The span name is the first positional argument, so `name` is free to
+        be an attribute.
+        """
+        parent: O[Span] = _current.get()
+        if parent is None:
+            if not root or random.random() >= self.sample_rate:
+                yield NOOP_SPAN
+                return
+            span = Span(uuid4().hex, span_name, attributes)
+        else:
+            span = Span(parent.trace_id, span_name, attributes)
+            parent.children.append(span)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.error = repr(exc)
+            raise
+        finally:
+            span.end = time.perf_counter()
+            _current.reset(token)
+            if parent is None:
+                self.traces.append(span)
+
+    def recent(self, limit: int = 20) -> L[D[str, A]]:
+        """Most recent traces first, each with its critical path"""
+        traces = list(self.traces)[-limit:][::-1]
+        return [
+            {
+                "trace_id": root.trace_id,
+                "name": root.name,
+                "duration_ms": round(root.duration * 1000, 3),
+                "critical_path": critical_path(root),
+                "spans": root.to_dict(),
+            }
+            for root in traces
+        ]
+
+
+tracer = Tracer(env.TRACE_SAMPLE_RATE, env.TRACE_BUFFER)
+
+
+@middleware
+async def trace_requests(request: Request, handler):
+    """Open a root span around every request"""
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else request.path
+    with tracer.span(f"{request.method} {route}", root=True) as span:
+        response = await handler(request)
+        span.set(status=response.status)
+        return response
@@ -0,0 +1,285 @@
+"""
+
+Per-upstream deadlines, retries, circuit breaking and stats
+
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any as A
+from typing import Awaitable, Callable
+from typing import Dict as D
+from typing import List as L
+from typing import Optional as O
+
+from aiohttp import ClientConnectorError, ClientError, ClientResponseError
+from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module
+
+from kubectl.config import AUTH0_URL, CLOUDFLARE_URL, DOCKER_URL, GITHUB_URL
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+
+class UpstreamError(Exception):
+    """Retryable upstream failure, carries the status when there was a response"""
+
+    def __init__(self, message: str, status: O[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the upstream while its breaker is open"""
+
+
+def is_failure(exc: BaseException) -> bool:
+    """Whether an exception means the upstream is unhealthy, as opposed to a client error"""
+    if isinstance(exc, ClientResponseError):
+        return exc.status >= 500 or exc.status in RETRYABLE_STATUSES
+    return isinstance(exc, (ClientError, asyncio.TimeoutError, UpstreamError))
+
+
+class UpstreamPolicy(BaseModel):
+    """
+
+    Resilience settings for one upstream
+
+    """
+
+    name: str = Field(..., description="Upstream name")
+    base_url: str = Field(..., description="URL prefix the policy applies to")
+    timeout: float = Field(30.0, description="Deadline per attempt, in seconds")
+    retries: int = Field(2, description="Retries after the first attempt")
+    backoff: float = Field(0.2, description="Base of the full-jitter exponential backoff")
+    retry_ratio: float = Field(0.2, description="Retries earned per request")
+    retry_burst: float = Field(10.0, description="Retry budget ceiling")
+    failure_threshold: int = Field(5, description="Consecutive failures that open the breaker")
+    reset_timeout: float = Field(30.0, description="Seconds before an open breaker lets a probe through")
+    hedge_after: O[float] = Field(None, description="Send a hedged GET after this many seconds")
+
+
+class CircuitBreaker:
+    """
+
+    Closed until `failure_threshold` consecutive failures, then open for
+    `reset_timeout` seconds, then half open with a single probe in flight.
+
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: O[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        """closed, open or half_open"""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def success(self):
+        """Record a healthy response"""
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        """Record a failed attempt"""
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def abandon(self):
+        """Forget an attempt that ended without an outcome, such as a cancelled probe"""
+        self.probing = False
+
+
+class RetryBudget:
+    """
+
+    Token bucket that lets retries be at most `ratio` of the traffic, so
+    retries cannot amplify an outage.
+
+    """
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def deposit(self):
+        """Credit one request"""
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Spend one retry if the budget allows it"""
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Upstream:
+    """
+
+    Runtime state of an upstream: breaker, retry budget and stats
+
+    """
+
+    def __init__(self, policy: UpstreamPolicy, window: int = 512):
+        self.policy = policy
+        self.breaker = CircuitBreaker(policy.failure_threshold, policy.reset_timeout)
+        self.budget = RetryBudget(policy.retry_ratio, policy.retry_burst)
+        self.latencies: "deque[float]" = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.hedges = 0
+        self.rejected = 0
+
+    def stats(self) -> D[str, A]:
+        """Latency percentiles and error counts"""
+        latencies = sorted(self.latencies)
+
+        def percentile(value: float) -> O[float]:
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(value * len(latencies)))]
+
+        return {
+            "name": self.policy.name,
+            "base_url": self.policy.base_url,
+            "state": self.breaker.state,
+            "requests": self.requests,
+            "errors": self.errors,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "rejected": self.rejected,
+            "retry_tokens": round(self.budget.tokens, 2),
+            "p50": percentile(0.5),
+            "p90": percentile(0.9),
+            "p99": percentile(0.99),
+        }
+
+    async def _attempt(self, send: Callable[[], Awaitable[A]]) -> A:
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(send(), self.policy.timeout)
+        except Exception as exc:
+            if is_failure(exc):
+                self.errors += 1
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        except BaseException:
+            self.breaker.abandon()
+            raise
+        finally:
+            self.latencies.append(time.monotonic() - started)
+        self.breaker.success()
+        return result
+
+    async def _hedged(self, send: Callable[[], Awaitable[A]]) -> A:
+        first = asyncio.ensure_future(self._attempt(send))
+        done, _ = await asyncio.wait({first}, timeout=self.policy.hedge_after)
+        if done or not self.budget.withdraw():
+            return await first
+        self.hedges += 1
+        second = asyncio.ensure_future(self._attempt(send))
+        pending = {first, second}
+        error: O[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+        assert error is not None
+        raise error
+
+    async def call(self, method: str, send: Callable[[], Awaitable[A]]) -> A:
+        """Run `send` under this upstream's deadline, retry, breaker and hedging policy"""
+        self.requests += 1
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.rejected += 1
+                raise CircuitOpenError(f"{self.policy.name} circuit is open")
+            try:
+                if method == "GET" and self.policy.hedge_after is not None:
+                    return await self._hedged(send)
+                return await self._attempt(send)
+            except Exception as exc:  # pylint: disable=broad-except
+                retryable = is_failure(exc) and (
+                    method in IDEMPOTENT_METHODS or isinstance(exc, ClientConnectorError)
+                )
+                if not retryable or attempt >= self.policy.retries or not self.budget.withdraw():
+                    raise
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(random.uniform(0, self.policy.backoff * 2 ** attempt))
+
+
+class Upstreams:
+    """
+
+    Registry resolving a URL to the upstream whose base URL prefixes it
+
+    """
+
+    def __init__(self, policies: L[UpstreamPolicy]):
+        self.upstreams: D[str, Upstream] = {}
+        for policy in policies:
+            self.register(policy)
+
+    def register(self, policy: UpstreamPolicy) -> Upstream:
+        """Add or replace an upstream policy, resetting its state"""
+        upstream = Upstream(policy)
+        self.upstreams[policy.name] = upstream
+        return upstream
+
+    def match(self, url: str) -> O[Upstream]:
+        """Upstream for a URL, None for unknown hosts"""
+        for upstream in self.upstreams.values():
+            if url.startswith(upstream.policy.base_url):
+                return upstream
+        return None
+
+    def stats(self) -> L[D[str, A]]:
+        """Stats of every upstream"""
+        return [upstream.stats() for upstream in self.upstreams.values()]
+
+
+upstreams = Upstreams(
+    [
+        UpstreamPolicy(name="docker", base_url=DOCKER_URL, timeout=60.0),
+        UpstreamPolicy(name="cloudflare", base_url=CLOUDFLARE_URL, timeout=15.0),
+        UpstreamPolicy(name="github", base_url=GITHUB_URL, timeout=15.0, hedge_after=1.0),
+        UpstreamPolicy(name="auth0", base_url=AUTH0_URL, timeout=10.0, hedge_after=0.5),
+    ]
+)
@@ -0,0 +1,130 @@
+"""
+
+Per-user usage totals kept incrementally in Redis
+
+"""
+import asyncio
+from collections import defaultdict
+from typing import Dict as D
+
+from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module
+
+from kubectl.config import env
+from kubectl.containers import container_index
+from kubectl.decorators import get_redis
+from kubectl.locks import try_lock
+
+FIELDS = ("bytes", "uploads", "running", "containers")
+
+USERS_KEY = "usage:users"
+
+
+class Usage(BaseModel):
+    """
+
+    Resources held by one user
+
+    """
+
+    user: str = Field(..., description="User reference")
+    bytes: int = Field(0, description="Bytes stored in uploads")
+    uploads: int = Field(0, description="Uploaded files")
+    running: int = Field(0, description="Running containers")
+    containers: int = Field(0, description="Deployed containers, running or not")
+
+
+class UsageLedger:
+    """
+
+    Running totals per user, stored as one Redis hash per user so reads are a
+    single HGETALL whatever the size of the collections.
+
+    Handlers apply deltas as they create and delete records. Failed or racing
+    updates can make the totals drift, so one worker, elected through a lock,
+    recomputes them from Fauna and the container index every
+    `USAGE_RECONCILE_INTERVAL` seconds.
+
+    """
+
+    def __init__(self):
+        self._task = None
+        self.reconciled = 0
+
+    @staticmethod
+    def key(user: str) -> str:
+        """Redis hash holding the totals of `user`"""
+        return f"usage:{user}"
+
+    async def add(self, user: str, **deltas: int):
+        """Apply deltas to the totals of `user` in one round trip, never failing the caller"""
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.sadd(USERS_KEY, user)
+                for field, delta in deltas.items():
+                    pipe.hincrby(self.key(user), field, delta)
+                await pipe.execute()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+    async def get(self, user: str) -> Usage:
+        """Current totals of `user`"""
+        values = await get_redis().hgetall(self.key(user))
+        return Usage(user=user, **{k.decode(): int(v) for k, v in values.items()})
+
+    async def reconcile(self):
+        """Recompute every user's totals from the records"""
+        from kubectl.models import Container, Upload  # pylint: disable=import-outside-toplevel
+
+        totals: D[str, D[str, int]] = defaultdict(lambda: dict.fromkeys(FIELDS, 0))
+        for upload in await Upload.all():
+            totals[upload.user]["bytes"] += upload.size
+            totals[upload.user]["uploads"] += 1
+        for container in await Container.all():
+            totals[container.user]["containers"] += 1
+            record = container_index.get(container.container_id or container.name)
+            if record is not None and record.state == "running":
+                totals[container.user]["running"] += 1
+        redis = get_redis()
+        known = {user.decode() for user in await redis.smembers(USERS_KEY)}
+        async with redis.pipeline(transaction=False) as pipe:
+            for user in known - set(totals):
+                pipe.delete(self.key(user))
+                pipe.srem(USERS_KEY, user)
+            for user, fields in totals.items():
+                pipe.hset(self.key(user), mapping=fields)
+                pipe.sadd(USERS_KEY, user)
+            await pipe.execute()
+        self.reconciled += 1
+
+    async def run(self):
+        """Reconcile periodically while this worker holds the usage lock"""
+        fd = None
+        while True:
+            try:
+                if fd is None:
+                    fd = try_lock("usage")
+                if fd is not None:
+                    await self.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                pass
+            await asyncio.sleep(env.USAGE_RECONCILE_INTERVAL)
+
+    def start(self):
+        """Start the periodic reconciliation"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """Stop the periodic reconciliation"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+usage = UsageLedger()
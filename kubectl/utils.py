@@ -1,6 +1,5 @@
 """Utility functions for the API."""
 import os
-import socket
 from datetime import datetime
 from random import choice, randint
 from secrets import token_urlsafe
@@ -9,39 +8,42 @@ from uuid import uuid4
 
 def get_dir_size(path="."):
     """Get the size of a directory in bytes."""
-    total = 0
-    with os.scandir(path) as it_:
-        for entry in it_:
-            if entry.is_file():
-                total += entry.stat().st_size
-            elif entry.is_dir():
-                total += get_dir_size(entry.path)
-    return total
-
-
-def build_file_tree(root_dir):
-    """Build a file tree from a given directory."""
+    from kubectl.scanner import scanner  # pylint: disable=import-outside-toplevel
+
+    return scanner.dir_size(path)
+
+
+def build_file_tree(root_dir, max_depth=8, max_entries=10000, max_file_bytes=64 * 1024):
+    """Build a file tree from a given directory, bounded by depth and entry count."""
+    from kubectl.scanner import scanner  # pylint: disable=import-outside-toplevel
+
     file_tree = {
-        "name": os.path.basename(root_dir),
+        "name": os.path.basename(os.path.normpath(root_dir)),
         "type": "directory",
         "children": [],
     }
-
-    for file_name in os.listdir(root_dir):
-        file_path = os.path.join(root_dir, file_name)
-
-        if os.path.isdir(file_path):
-            file_tree["children"].append(build_file_tree(file_path))
+    directories = {".": file_tree}
+    for node in scanner.iter_tree(
+        root_dir, max_depth, max_entries, max_file_bytes, content=True
+    ):
+        if node["type"] == "truncated":
+            file_tree["truncated"] = node["reason"]
+            continue
+        parent = directories[os.path.dirname(node["path"]) or "."]
+        if node["type"] == "directory":
+            child = {"name": node["name"], "type": "directory", "children": []}
+            directories[node["path"]] = child
         else:
-            try:
-                with open(file_path, "r", encoding="utf-8") as file_:
-                    file_content = file_.read()
-            except:
-                file_content = "[BINARY]"
-
-            file_tree["children"].append(
-                {"name": file_name, "type": "file", "content": file_content}
-            )
+            child = {"name": node["name"], "type": "file", "size": node.get("size")}
+            if node.get("binary"):
+                child["content"] = "[BINARY]"
+            elif "content" in node:
+                child["content"] = node["content"]
+            elif node.get("unreadable"):
+                child["content"] = "[UNREADABLE]"
+            else:
+                child["truncated"] = True
+        parent["children"].append(child)
 
     return file_tree
 
@@ -77,10 +79,7 @@ def gen_secret():
 
 
 def gen_port():
-    """Generate a random port."""
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind(("", 0))
-    s.listen(1)
-    port = s.getsockname()[1]
-    s.close()
-    return port
+    """Lease a free host port."""
+    from kubectl.ports import port_allocator  # pylint: disable=import-outside-toplevel
+
+    return port_allocator.allocate()
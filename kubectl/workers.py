@@ -0,0 +1,148 @@
+"""
+
+Multi-process serving over a shared SO_REUSEPORT socket
+
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+from typing import List as L
+
+from aiohttp.log import server_logger
+from aiohttp.web import Application, AppRunner, TCPSite
+
+RESPAWN_WINDOW = 10.0
+
+RESPAWN_LIMIT = 5
+
+
+def _worker(app: Application, host: str, port: int, ready, shutdown_timeout: float):
+    """Serve `app` until SIGTERM, then drain in-flight requests"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    async def serve():
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        runner = AppRunner(app, handle_signals=False)
+        await runner.setup()
+        site = TCPSite(runner, host, port, reuse_port=True, shutdown_timeout=shutdown_timeout)
+        await site.start()
+        ready.set()
+        await stop.wait()
+        await runner.cleanup()
+
+    asyncio.run(serve())
+
+
+class Supervisor:
+    """
+
+    Forks `workers` processes that each bind `host:port` with SO_REUSEPORT,
+    so the kernel balances connections across cores.
+
+    Crashed workers are respawned, with a pause when they crash in a loop.
+    SIGHUP replaces workers one at a time, starting the replacement before
+    draining the old one so the port never stops accepting. Workers are
+    forked from this process, so a restart recycles them but does not load
+    new code. SIGTERM and SIGINT drain every worker and exit.
+
+    """
+
+    def __init__(
+        self,
+        app: Application,
+        host: str = "0.0.0.0",
+        port: int = 8080,
+        workers: int = 2,
+        shutdown_timeout: float = 30.0,
+    ):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.shutdown_timeout = shutdown_timeout
+        self.context = multiprocessing.get_context("fork")
+        self.processes: L[multiprocessing.Process] = []
+        self.respawns: L[float] = []
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self) -> multiprocessing.Process:
+        """Fork a worker and wait until it is accepting connections"""
+        ready = self.context.Event()
+        process = self.context.Process(
+            target=_worker,
+            args=(self.app, self.host, self.port, ready, self.shutdown_timeout),
+            daemon=False,
+        )
+        process.start()
+        ready.wait(timeout=self.shutdown_timeout)
+        return process
+
+    def drain(self, process: multiprocessing.Process):
+        """Gracefully stop a worker, killing it past the shutdown timeout"""
+        if process.is_alive():
+            process.terminate()
+        process.join(self.shutdown_timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def rolling_restart(self):
+        """Replace every worker, one at a time"""
+        for index, process in enumerate(list(self.processes)):
+            self.processes[index] = self.spawn()
+            self.drain(process)
+
+    def respawn(self, index: int):
+        """Replace a dead worker, backing off when workers crash in a loop"""
+        now = time.monotonic()
+        self.respawns = [t for t in self.respawns if now - t < RESPAWN_WINDOW]
+        if len(self.respawns) >= RESPAWN_LIMIT:
+            time.sleep(RESPAWN_WINDOW / RESPAWN_LIMIT)
+        self.respawns.append(time.monotonic())
+        self.processes[index] = self.spawn()
+
+    def _stop(self, *_):
+        self.stopping = True
+
+    def _reload(self, *_):
+        self.reloading = True
+
+    def run(self):
+        """Supervise the workers until SIGTERM or SIGINT"""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        self.processes = [self.spawn() for _ in range(self.workers)]
+        server_logger.info(
+            "Serving on http://%s:%s with %d workers, supervisor pid %d",
+            self.host,
+            self.port,
+            self.workers,
+            os.getpid(),
+        )
+        while not self.stopping:
+            time.sleep(0.5)
+            if self.reloading:
+                self.reloading = False
+                self.rolling_restart()
+            for index, process in enumerate(self.processes):
+                if not process.is_alive() and not self.stopping:
+                    self.respawn(index)
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            self.drain(process)
+
+
+def serve(app: Application, host: str = "0.0.0.0", port: int = 8080, workers: int = 1):
+    """Run `app` in this process, or under a Supervisor when `workers` > 1"""
+    if workers > 1:
+        Supervisor(app, host, port, workers).run()
+    else:
+        app.run(host=host, port=port)  # type: ignore
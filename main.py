@@ -1,22 +1,31 @@
 """Application endpoints"""
 import asyncio
+import json
 from uuid import uuid4
 
-from aioboto3 import Session
 from aiofauna import (FaunaModel, FileField,  # pylint: disable=all
                       HttpException, Request, redirect)
-from botocore.config import Config
+from aiohttp.web import StreamResponse
 from dotenv import load_dotenv
-from jinja2.utils import F
 
+from kubectl.admission import Rejected, admission, too_many_requests
 from kubectl.client import client
-from kubectl.config import DOCKER_URL, env
-from kubectl.handlers import (app, docker_build_from_github_tarball,
+from kubectl.config import AUTH0_URL, DOCKER_URL, env
+from kubectl.containers import container_index
+from kubectl.handlers import (app, build_image, get_latest_commit_sha,
                               start_container)
-from kubectl.helpers import provision_instance
+from kubectl.helpers import provision_instance, render_codeserver_template
+from kubectl.idle import idle_manager
+from kubectl.locks import run_once
 from kubectl.models import Container, Upload, User
-from kubectl.payload import RepoDeployPayload
+from kubectl.payload import BatchDeployPayload, RepoDeployPayload
+from kubectl.ports import port_allocator
+from kubectl.redeploy import redeployer
+from kubectl.storage import storage
+from kubectl.tracing import tracer
+from kubectl.usage import usage
 from kubectl.utils import gen_port
+from kubectl.workers import serve
 
 load_dotenv()
 
@@ -30,7 +39,7 @@ load_dotenv()
 async def authorize(token: str):
     """Authorization Endpoint, exchange token for user info"""
     headers = {"Authorization": f"Bearer {token}"}
-    url = f"https://dev-tvhqmk7a.us.auth0.com/userinfo"
+    url = f"{AUTH0_URL}/userinfo"
     user_dict = await client.fetch(url, headers=headers)
     return await User(**user_dict).save()
 
@@ -42,13 +51,13 @@ async def change_profile_picture(ref:str,picture:str):
 
 #### Bucket obj Endpoints ####
 
-session = Session()
-
 
 @app.delete("/api/upload")
 async def delete_upload(ref: str):
     """Delete an uploaded file given it's document reference"""
-    await Upload.delete(ref)
+    upload = await Upload.get(ref)
+    if await Upload.delete(ref) and isinstance(upload, Upload):
+        await usage.add(upload.user, bytes=-upload.size, uploads=-1)
     return {"message": "Asset deleted successfully", "status": "success"}
     
 
@@ -70,13 +79,7 @@ async def upload_handler(request: Request):
         size = int(size)
         file = data["file"]
         if isinstance(file, FileField):
-            async with session.client(
-                service_name="s3",
-                aws_access_key_id=env.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=env.AWS_SECRET_ACCESS_KEY,
-                endpoint_url=env.AWS_S3_ENDPOINT,
-                config=Config(signature_version="s3v4"),
-            ) as s3client:  # type: ignore
+            async with storage.client() as s3client:  # type: ignore
                 key_ = f"{key}/{file.filename}"  # type: ignore
                 await s3client.put_object(
                     Bucket=env.AWS_S3_BUCKET,
@@ -90,7 +93,7 @@ async def upload_handler(request: Request):
                     Params={"Bucket": env.AWS_S3_BUCKET, "Key": key_},
                     ExpiresIn=3600 * 7 * 24,
                 )
-                return await Upload(
+                upload = await Upload(
                     user=user,
                     key=key_,
                     name=file.filename,
@@ -98,49 +101,61 @@ async def upload_handler(request: Request):
                     content_type=file.content_type,
                     url=url,
                 ).save()
+                await usage.add(user, bytes=size, uploads=1)
+                return upload
     return {"message": "Invalid request", "status": "error"}
 
 async def container_exists(id:str)->bool:
     """Check if a container exists"""
-    try:
-        await client.fetch(f"{DOCKER_URL}/containers/{id}/json")
-        return True
-    except Exception as e:
-        return False
+    return await container_index.lookup(id) is not None
 
    
 @app.delete("/api/container/{name}")
 async def delete_container(name:str):
     """Delete a container"""
-    await Container.delete(name)
-    containers = await client.fetch(f"{DOCKER_URL}/containers/json?all=true")
-    for container in containers:
-        if name in container["Names"]:
-            if container["State"] == "running":
-                await client.text(f"{DOCKER_URL}/containers/{container['Id']}/stop","POST") 
-            await client.text(f"{DOCKER_URL}/containers/{container['Id']}","DELETE")
+    instance = await Container.find_unique("name", name)
+    if isinstance(instance, Container):
+        assert isinstance(instance.ref, str)
+        await Container.delete(instance.ref)
+    container = await container_index.lookup(
+        instance.container_id if isinstance(instance, Container) and instance.container_id else name
+    )
+    if isinstance(instance, Container):
+        running = container is not None and container.state == "running"
+        await usage.add(instance.user, containers=-1, running=-int(running))
+    if container is not None:
+        if container.state == "running":
+            await client.text(f"{DOCKER_URL}/containers/{container.id}/stop","POST") 
+        await client.text(f"{DOCKER_URL}/containers/{container.id}","DELETE")
+        container_index.discard(container.id)
+        for port in container.ports:
+            port_allocator.release(port)
+    elif isinstance(instance, Container) and instance.port:
+        # Removed behind our back, its lease is only known from the record
+        port_allocator.release(instance.port)
+    await idle_manager.unregister(name)
 
 
 
 @app.post("/api/deploy/{owner}/{repo}")
-async def deploy_container_from_repo(owner:str,repo:str,body:RepoDeployPayload
+async def deploy_container_from_repo(owner:str,repo:str,user:str,body:RepoDeployPayload
 ):
-    """Deploy a container from a github repo"""
+    """Deploy a container from a github repo on behalf of `user`"""
     sha = uuid4().hex[:7]
     name = f"{owner}-{repo}-{sha}"    
     instance = await Container.find_unique("name",name)
     if instance is not None:
        await delete_container(name) 
     host_port = str(gen_port())
-    image = await docker_build_from_github_tarball(owner, repo)
-    if image is None:
-        raise Exception("Failed to build image")
-    payload = {
-        "Image": image,
-        "Env": body.env_vars,
-        "ExposedPorts": {f"{str(body.port)}/tcp": {"HostPort": host_port}},
-        "HostConfig": {"PortBindings": {f"{str(body.port)}/tcp": [{"HostPort": host_port}]}},
-    }
+    try:
+        commit = await get_latest_commit_sha(owner, repo)
+        image = await build_image(owner, repo, commit)
+        if image is None:
+            raise Exception("Failed to build image")
+    except Exception:
+        port_allocator.release(int(host_port))
+        raise
+    payload = body.container_config(image, int(host_port))
     container = await client.fetch(
         f"{DOCKER_URL}/containers/create?name={name}",
         "POST",
@@ -151,8 +166,13 @@ async def deploy_container_from_repo(owner:str,repo:str,body:RepoDeployPayload
     try:
         _id = container["Id"]
         await start_container(_id)
-        res = await provision_instance(name, int(host_port))
-        data = await client.fetch(f"{DOCKER_URL}/containers/{_id}/json")
+        res = await provision_instance(name, int(host_port), container=_id)
+        with tracer.span("docker.wait_running", id=_id):
+            record = await container_index.wait_for(_id, "running")
+        if record is not None and record.data is not None:
+            data = record.data
+        else:
+            data = await client.fetch(f"{DOCKER_URL}/containers/{_id}/json")
         data = {
             "url": f"https://{name}.smartpro.solutions",
             "port": host_port,
@@ -160,33 +180,104 @@ async def deploy_container_from_repo(owner:str,repo:str,body:RepoDeployPayload
             "dns": res,
             "image": image,
         }
+        await Container(
+            owner=owner,
+            repo=repo,
+            name=name,
+            user=user,
+            url=data["url"],
+            repo_payload=body,
+            sha=commit,
+            image=image,
+            container_id=_id,
+            port=int(host_port),
+        ).save()
+        await usage.add(user, containers=1, running=1)
     except Exception as e:
+        # The created container holds the port binding, remove it before
+        # handing the port to another deploy
+        try:
+            await client.text(f"{DOCKER_URL}/containers/{_id}?force=true", "DELETE")
+            container_index.discard(_id)
+            port_allocator.release(int(host_port))
+        except Exception:  # pylint: disable=broad-except
+            pass
         raise Exception("Failed to start container")
     return {
         "data": data,
         "res": res,
         "id": _id,
     }
-    
-    
- 
+
+
+@app.post("/api/deploy")
+async def batch_deploy(request: Request, user: str, body: BatchDeployPayload):
+    """Deploy many repos with bounded concurrency, streaming one JSON line per finished item.
+
+    Every item is admitted like a single deploy: items over the caller's
+    build rate wait for it, up to `DEPLOY_ADMISSION_WAIT` seconds, before
+    being reported as rejected with their own retry_after.
+    """
+    try:
+        caller = await admission.caller(request)
+    except Rejected as e:
+        return too_many_requests(e)
+    response = StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    concurrency = min(body.concurrency or env.DEPLOY_CONCURRENCY, env.DEPLOY_CONCURRENCY)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def deploy(index: int, owner: str, repo: str, payload: RepoDeployPayload):
+        async with semaphore:
+            try:
+                data = await admission.admit(
+                    "build",
+                    caller,
+                    lambda: deploy_container_from_repo(owner, repo, user, payload),
+                    wait=env.DEPLOY_ADMISSION_WAIT,
+                )
+                return {"index": index, "owner": owner, "repo": repo, "status": "success", "data": data}
+            except Rejected as e:
+                return {
+                    "index": index,
+                    "owner": owner,
+                    "repo": repo,
+                    "status": "rejected",
+                    "message": e.reason,
+                    "retry_after": round(e.retry_after, 1),
+                }
+            except Exception as e:
+                return {"index": index, "owner": owner, "repo": repo, "status": "error", "message": str(e)}
+
+    deploys = [deploy(i, item.owner, item.repo, item.payload) for i, item in enumerate(body.items)]
+    for result in asyncio.as_completed(deploys):
+        await response.write(f"{json.dumps(await result)}\n".encode())
+    await response.write_eof()
+    return response
+
     
 @app.put("/api/container/{name}")
 async def update_container(name:str):
-    """Update a container"""
+    """Roll a container to the latest commit of its repo, unless it already runs it"""
     instance = await Container.find_unique("name",name)
     if isinstance(instance,Container):
-        assert isinstance(instance.ref,str)
-        assert isinstance(instance.repo_payload,RepoDeployPayload)
-        await Container.delete(instance.ref)
-        await client.text(f"{DOCKER_URL}/containers/{name}",method="DELETE")
-        return await deploy_container_from_repo(instance.owner,instance.repo,instance.user,instance.repo_payload)
+        sha = await get_latest_commit_sha(instance.owner, instance.repo)
+        if instance.sha == sha:
+            return {"message": "Container is up to date", "status": "success", "sha": sha}
+        image = await build_image(instance.owner, instance.repo, sha)
+        await redeployer.roll(instance, image, sha)
+        return {"message": "Container updated", "status": "success", "sha": sha, "image": image}
     return {"message":"Container not found","status":"error"}
 
 @app.get("/api/container/{user}")
-async def get_container(ref:str):
-    """Get a container"""
-    return await Container.find_many("user",ref)
+async def get_container(user:str):
+    """Containers deployed by a user"""
+    return await Container.find_many("user",user)
+
+@app.get("/api/usage/{user}")
+async def get_usage(user:str):
+    """Storage and container totals of a user, without scanning the collections"""
+    return await usage.get(user)
 
 import inspect
 
@@ -200,7 +291,35 @@ async def index():
 
 @app.on_event("startup")
 async def startup(_):
-    await asyncio.gather(*[m.provision() for m in models_])
+    try:
+        await container_index.sync()
+    except Exception:  # pylint: disable=broad-except
+        pass
+    container_index.start()
+    idle_manager.start()
+    usage.start()
+    loop = asyncio.get_running_loop()
+
+    async def provision():
+        # Leases survive restarts, so rebuild them from what Docker actually
+        # holds to drop those of failed creates, crashes and containers removed
+        # behind our back. Skipped when Docker could not be listed.
+        if container_index.ready:
+            port_allocator.rebuild(
+                port for record in list(container_index.by_id.values()) for port in record.ports
+            )
+        await asyncio.gather(
+            *[m.provision() for m in models_],
+            loop.run_in_executor(None, render_codeserver_template),
+        )
+
+    await run_once("startup", provision)
+
+@app.on_event("shutdown")
+async def shutdown(_):
+    await idle_manager.stop()
+    await usage.stop()
+    await container_index.stop()
 
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    serve(app, workers=env.WORKERS)
\ No newline at end of file
@@ -0,0 +1,594 @@
+"""
+
+Load test and benchmark suite
+
+Starts local aiohttp fakes for Docker, Cloudflare, GitHub, Auth0 and S3,
+replaces the Fauna ORM with an in-memory store, points the real `app` at
+them, drives it with a concurrent load generator and prints a JSON report
+(req/s, p50/p99 latency, RSS, open FDs) that can be diffed between commits:
+
+    python scripts/bench.py --concurrency 32 --requests 500 --output bench.json
+
+Every fake, Fauna included, has a configurable latency and error rate, so
+retry, breaker and error paths can be measured on purpose:
+
+    python scripts/bench.py --error-rate 0.05 --upstream-latency docker=50
+
+With --real-fauna the records go to the database FAUNA_SECRET points at
+instead, which must then be a disposable test database.
+
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from itertools import count
+from typing import Any as A
+from typing import Callable
+from typing import Dict as D
+from typing import List as L
+from uuid import uuid4
+
+import psutil
+from aiohttp import ClientSession, FormData, web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+UPSTREAMS = ("docker", "cloudflare", "github", "auth0", "s3")
+
+FAUNA = "fauna"
+
+
+class Fakes:
+    """
+
+    One aiohttp app per upstream, each with a configurable latency, error
+    rate and payload padding
+
+    """
+
+    def __init__(self, latency: D[str, float], errors: D[str, float], payload_bytes: int):
+        self.latency = latency
+        self.errors = errors
+        self.injected: D[str, int] = defaultdict(int)
+        self.padding = "x" * payload_bytes
+        self.containers: D[str, D[str, A]] = {}
+        self.subscribers: L[asyncio.Queue] = []
+        self.runners: L[web.AppRunner] = []
+        self.urls: D[str, str] = {}
+
+    def app(self, upstream: str) -> web.Application:
+        """App whose requests get the latency and error rate of `upstream`"""
+
+        @web.middleware
+        async def disturb(request: web.Request, handler):
+            if self.latency.get(upstream):
+                await asyncio.sleep(self.latency[upstream])
+            if random.random() < self.errors.get(upstream, 0.0):
+                self.injected[upstream] += 1
+                return web.json_response({"message": "Injected failure"}, status=503)
+            return await handler(request)
+
+        return web.Application(middlewares=[disturb])
+
+    def emit(self, action: str, id_: str):
+        """Publish a container event to /events subscribers"""
+        event = {
+            "Type": "container",
+            "Action": action,
+            "Actor": {"ID": id_, "Attributes": {"name": self.containers.get(id_, {}).get("Name", "")}},
+        }
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+    def inspect(self, id_: str) -> D[str, A]:
+        """Docker-like inspect payload"""
+        container = self.containers[id_]
+        return {
+            "Id": id_,
+            "Name": f"/{container['Name']}",
+            "State": {"Status": container["State"]},
+            "Config": {"Image": container["Image"], "Labels": {"padding": self.padding}},
+            "HostConfig": {"PortBindings": container["Ports"]},
+            "NetworkSettings": {"Ports": container["Ports"] if container["State"] == "running" else {}},
+        }
+
+    def docker(self) -> web.Application:
+        """Fake Docker Engine API"""
+        app = self.app("docker")
+
+        async def build(_):
+            return web.Response(text='{"stream":"Successfully built 0123456789ab\\n"}\r\n')
+
+        async def create(request: web.Request):
+            body = await request.json()
+            id_ = uuid4().hex + uuid4().hex
+            self.containers[id_] = {
+                "Name": request.query.get("name", id_[:12]),
+                "Image": body.get("Image"),
+                "State": "created",
+                "Ports": body.get("HostConfig", {}).get("PortBindings", {}),
+            }
+            self.emit("create", id_)
+            return web.json_response({"Id": id_, "Warnings": []}, status=201)
+
+        async def start(request: web.Request):
+            id_ = request.match_info["id"]
+            self.containers[id_]["State"] = "running"
+            self.emit("start", id_)
+            return web.Response(status=204)
+
+        async def stop(request: web.Request):
+            id_ = request.match_info["id"]
+            self.containers[id_]["State"] = "exited"
+            self.emit("stop", id_)
+            return web.Response(status=204)
+
+        async def inspect(request: web.Request):
+            id_ = request.match_info["id"]
+            if id_ not in self.containers:
+                return web.json_response({"message": "No such container"}, status=404)
+            return web.json_response(self.inspect(id_))
+
+        async def remove(request: web.Request):
+            id_ = request.match_info["id"]
+            self.emit("destroy", id_)
+            self.containers.pop(id_, None)
+            return web.Response(status=204)
+
+        async def listing(_):
+            return web.json_response(
+                [
+                    {"Id": id_, "Names": [f"/{c['Name']}"], "State": c["State"], "Image": c["Image"], "Ports": []}
+                    for id_, c in self.containers.items()
+                ]
+            )
+
+        async def events(request: web.Request):
+            response = web.StreamResponse()
+            await response.prepare(request)
+            queue: asyncio.Queue = asyncio.Queue()
+            self.subscribers.append(queue)
+            try:
+                while True:
+                    event = await queue.get()
+                    await response.write(f"{json.dumps(event)}\n".encode())
+            finally:
+                self.subscribers.remove(queue)
+
+        app.router.add_post("/build", build)
+        app.router.add_post("/containers/create", create)
+        app.router.add_post("/containers/{id}/start", start)
+        app.router.add_post("/containers/{id}/stop", stop)
+        app.router.add_get("/containers/json", listing)
+        app.router.add_get("/containers/{id}/json", inspect)
+        app.router.add_delete("/containers/{id}", remove)
+        app.router.add_get("/events", events)
+        return app
+
+    def cloudflare(self) -> web.Application:
+        """Fake Cloudflare DNS API"""
+        app = self.app("cloudflare")
+
+        async def dns_record(request: web.Request):
+            body = await request.json()
+            return web.json_response({"success": True, "result": {"id": uuid4().hex, **body}})
+
+        app.router.add_post("/zones/{zone}/dns_records", dns_record)
+        return app
+
+    def github(self) -> web.Application:
+        """Fake GitHub REST API, honouring If-None-Match"""
+        app = self.app("github")
+
+        async def commits(request: web.Request):
+            etag = '"bench"'
+            if request.headers.get("If-None-Match") == etag:
+                return web.Response(status=304)
+            return web.json_response([{"sha": "0123456789abcdef0123456789abcdef01234567"}], headers={"ETag": etag})
+
+        app.router.add_get("/repos/{owner}/{repo}/commits", commits)
+        return app
+
+    def auth0(self) -> web.Application:
+        """Fake Auth0 userinfo endpoint"""
+        app = self.app("auth0")
+
+        async def userinfo(_):
+            return web.json_response({"sub": "bench|user", "name": "Bench User", "email": "bench@example.com"})
+
+        app.router.add_get("/userinfo", userinfo)
+        return app
+
+    def s3(self) -> web.Application:
+        """Fake S3 endpoint accepting PutObject"""
+        app = self.app("s3")
+
+        async def put_object(request: web.Request):
+            await request.read()
+            return web.Response(status=200, headers={"ETag": f'"{uuid4().hex}"'})
+
+        app.router.add_put("/{bucket}/{key:.*}", put_object)
+        return app
+
+    async def start(self):
+        """Serve every fake on an ephemeral local port"""
+        for upstream in UPSTREAMS:
+            runner = web.AppRunner(getattr(self, upstream)())
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            port = runner.addresses[0][1]
+            self.runners.append(runner)
+            self.urls[upstream] = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        """Shut every fake down"""
+        for runner in self.runners:
+            await runner.cleanup()
+
+
+class FakeFauna:
+    """
+
+    In-memory stand-in for the Fauna ORM, patched over `FaunaModel` so the
+    endpoints that persist records run without a database.
+
+    Every call sleeps the configured latency and fails at the configured
+    rate the way aiofauna reports a failed query: None, an empty list, False,
+    or ValueError from `update`.
+
+    """
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.collections: D[str, D[str, D[str, A]]] = defaultdict(dict)
+        self.refs = count(10**17)
+        self.calls = 0
+        self.failures = 0
+
+    async def call(self) -> bool:
+        """Sleep the latency, returning False when this call is to fail"""
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.failures += 1
+            return False
+        return True
+
+    def rows(self, model) -> D[str, D[str, A]]:
+        """Stored documents of a model, by ref"""
+        return self.collections[model.__name__.lower()]
+
+    @staticmethod
+    def load(model, ref: str, data: D[str, A]):
+        """Model instance of a stored document"""
+        return model(**{**data, "ref": ref, "ts": time.time()})
+
+    def install(self):
+        """Replace the ORM methods of every FaunaModel"""
+        from aiofauna import FaunaModel  # pylint: disable=import-outside-toplevel
+
+        fake = self
+
+        async def provision(cls):
+            return await fake.call()
+
+        async def exists(cls, ref):
+            return await fake.call() and ref in fake.rows(cls)
+
+        async def find_unique(cls, field, value):
+            if not await fake.call():
+                return None
+            rows = fake.rows(cls).items()
+            return next((fake.load(cls, ref, d) for ref, d in rows if d.get(field) == value), None)
+
+        async def find_many(cls, field, value):
+            if not await fake.call():
+                return []
+            return [fake.load(cls, ref, d) for ref, d in fake.rows(cls).items() if d.get(field) == value]
+
+        async def get(cls, ref):
+            if not await fake.call() or ref not in fake.rows(cls):
+                return None
+            return fake.load(cls, ref, fake.rows(cls)[ref])
+
+        async def all_(cls):
+            if not await fake.call():
+                return []
+            return [fake.load(cls, ref, d) for ref, d in fake.rows(cls).items()]
+
+        async def delete_unique(cls, field, value):
+            if not await fake.call():
+                return False
+            rows = fake.rows(cls)
+            ref = next((ref for ref, d in rows.items() if d.get(field) == value), None)
+            return ref is not None and rows.pop(ref, None) is not None
+
+        async def delete(cls, ref):
+            if not await fake.call():
+                return False
+            return fake.rows(cls).pop(ref, None) is not None
+
+        async def update(cls, ref, **kwargs):
+            rows = fake.rows(cls)
+            if not await fake.call() or ref not in rows:
+                raise ValueError(f"Field {ref} not found")
+            changes = kwargs.get("kwargs", kwargs)
+            rows[ref].update({k: v for k, v in changes.items() if k not in ("ref", "ts")})
+            return fake.load(cls, ref, rows[ref])
+
+        async def create(self):
+            if not await fake.call():
+                return None
+            rows = fake.rows(type(self))
+            for name, field in self.__fields__.items():
+                value = getattr(self, name)
+                if value is not None and field.field_info.extra.get("unique"):
+                    for ref, data in rows.items():
+                        if data.get(name) == value:
+                            return fake.load(type(self), ref, data)
+            self.ref = str(next(fake.refs))
+            self.ts = time.time()
+            rows[self.ref] = json.loads(self.json(exclude={"ref", "ts"}))
+            return self
+
+        for name, method in (
+            ("provision", provision),
+            ("exists", exists),
+            ("find_unique", find_unique),
+            ("find_many", find_many),
+            ("get", get),
+            ("all", all_),
+            ("delete_unique", delete_unique),
+            ("delete", delete),
+            ("update", update),
+        ):
+            setattr(FaunaModel, name, classmethod(method))
+        FaunaModel.create = create
+
+    def stats(self) -> D[str, A]:
+        """Calls made, failures injected and documents stored"""
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "documents": {name: len(rows) for name, rows in self.collections.items()},
+        }
+
+
+def configure(urls: D[str, str], workdir: str):
+    """Point the service environment at the fakes, before `main` is imported"""
+    nginx_dir = os.path.join(workdir, "nginx")
+    os.makedirs(nginx_dir, exist_ok=True)
+    defaults = {
+        "FAUNA_SECRET": "bench",
+        "API_KEY": "bench",
+        "GITHUB_TOKEN": "bench",
+        "AUTH0_DOMAIN": "bench",
+        "REDIS_PASSWORD": "bench",
+        "REDIS_HOST": "127.0.0.1",
+        "REDIS_PORT": "6379",
+        "REDIS_USER": "bench",
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_S3_BUCKET": "bench",
+        "CF_API_KEY": "bench",
+        "CF_EMAIL": "bench@example.com",
+        "CF_ZONE_ID": "bench",
+        "CF_ACCOUNT_ID": "bench",
+        "IP_ADDR": "127.0.0.1",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    os.environ.update(
+        {
+            "DOCKER_URL": urls["docker"],
+            "CLOUDFLARE_URL": urls["cloudflare"],
+            "GITHUB_URL": urls["github"],
+            "AUTH0_URL": urls["auth0"],
+            "AWS_S3_ENDPOINT": urls["s3"],
+            "NGINX_CONF_DIRS": json.dumps([nginx_dir]),
+            "NGINX_RELOAD_CMD": "true",
+            "PORT_LEASES_PATH": os.path.join(workdir, "ports"),
+            "LOCK_DIR": os.path.join(workdir, "locks"),
+            "TEMPLATE_CACHE_DIR": os.path.join(workdir, "template-cache"),
+            "IDLE_STATE_PATH": os.path.join(workdir, "idle.json"),
+            "NGINX_LOG_DIR": os.path.join(workdir, "nginx-logs"),
+            "PORT_RANGE_START": "40000",
+            "PORT_RANGE_END": "60000",
+        }
+    )
+    # Throughput runs measure the handlers, not the rate limits in front of them
+    os.environ.setdefault("ADMISSION_ENABLED", "false")
+
+
+def scenarios(payload_bytes: int) -> D[str, Callable[[ClientSession, str], A]]:
+    """Request factories, keyed by scenario name"""
+    upload_body = b"x" * max(payload_bytes, 1)
+
+    def deploy(session: ClientSession, base: str):
+        return session.post(
+            f"{base}/api/deploy/bench/repo",
+            params={"user": "bench"},
+            json={"env_vars": ["DOCKER=1"], "port": 8080},
+        )
+
+    def upload(session: ClientSession, base: str):
+        form = FormData()
+        form.add_field("file", upload_body, filename="bench.bin", content_type="application/octet-stream")
+        params = {"key": "bench", "size": str(len(upload_body)), "user": "bench|user"}
+        return session.post(f"{base}/api/upload", data=form, params=params)
+
+    def upload_list(session: ClientSession, base: str):
+        return session.get(f"{base}/api/upload", params={"user": "bench|user"})
+
+    def auth(session: ClientSession, base: str):
+        return session.get(f"{base}/api/auth", params={"token": "bench"})
+
+    def codeserver(session: ClientSession, base: str):
+        return session.get(f"{base}/api/codeserver", params={"ref": f"bench{uuid4().hex[:8]}"})
+
+    def container_list(session: ClientSession, base: str):
+        return session.get(f"{base}/api/container/bench")
+
+    return {
+        "deploy": deploy,
+        "upload": upload,
+        "upload_list": upload_list,
+        "auth": auth,
+        "codeserver": codeserver,
+        "container_list": container_list,
+    }
+
+
+def percentile(values: L[float], value: float) -> A:
+    """Nearest-rank percentile, None for an empty sample"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(value * len(values)))]
+
+
+async def drive(base: str, name: str, factory: Callable, concurrency: int, requests: int) -> D[str, A]:
+    """Fire `requests` requests with `concurrency` workers and summarize them"""
+    latencies: L[float] = []
+    statuses: D[str, int] = {}
+    errors = 0
+    remaining = iter(range(requests))
+    process = psutil.Process()
+
+    async def worker(session: ClientSession):
+        nonlocal errors
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                async with factory(session, base) as response:
+                    await response.read()
+                    status = str(response.status)
+            except Exception:  # pylint: disable=broad-except
+                status = "exception"
+            latencies.append(time.perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+            if not status.startswith("2"):
+                errors += 1
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        "scenario": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 4),
+        "rps": round(requests / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        "errors": errors,
+        "statuses": statuses,
+        "rss_bytes": process.memory_info().rss,
+        "open_fds": process.num_fds(),
+    }
+
+
+def git_revision() -> A:
+    """Commit being measured, if any"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+
+async def run(args: argparse.Namespace) -> D[str, A]:
+    """Start the fakes and the app, then run every selected scenario"""
+    latency = {upstream: args.latency_ms / 1000 for upstream in (*UPSTREAMS, FAUNA)}
+    for override in args.upstream_latency:
+        upstream, value = override.split("=")
+        latency[upstream] = float(value) / 1000
+    errors = {upstream: args.error_rate for upstream in (*UPSTREAMS, FAUNA)}
+    for override in args.upstream_error_rate:
+        upstream, value = override.split("=")
+        errors[upstream] = float(value)
+    fakes = Fakes(latency, errors, args.payload_bytes)
+    fauna = None if args.real_fauna else FakeFauna(latency[FAUNA], errors[FAUNA])
+    await fakes.start()
+    workdir = tempfile.mkdtemp(prefix="kubectl-bench-")
+    configure(fakes.urls, workdir)
+    # Code server volumes are created relative to the working directory
+    os.symlink(os.path.join(ROOT, "templates"), os.path.join(workdir, "templates"))
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    if fauna is not None:
+        fauna.install()
+    import main  # pylint: disable=import-outside-toplevel
+
+    if args.skip_provision:
+        main.app.on_startup.remove(main.startup)
+        main.container_index.start()
+    runner = web.AppRunner(main.app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base = f"http://127.0.0.1:{runner.addresses[0][1]}"
+    factories = scenarios(args.payload_bytes)
+    results = []
+    try:
+        for name in args.scenarios:
+            results.append(await drive(base, name, factories[name], args.concurrency, args.requests))
+    finally:
+        await runner.cleanup()
+        await fakes.stop()
+    return {
+        "revision": git_revision(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "latency_ms": {k: v * 1000 for k, v in latency.items()},
+        "error_rate": errors,
+        "injected_errors": dict(fakes.injected),
+        "fauna": fauna.stats() if fauna is not None else "real",
+        "payload_bytes": args.payload_bytes,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="Latency of every fake upstream")
+    parser.add_argument(
+        "--upstream-latency", action="append", default=[], metavar="NAME=MS", help="Per-upstream latency override"
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of calls every fake fails, 0 to 1")
+    parser.add_argument(
+        "--upstream-error-rate", action="append", default=[], metavar="NAME=RATE", help="Per-upstream error rate override"
+    )
+    parser.add_argument(
+        "--real-fauna", action="store_true", help="Use the database FAUNA_SECRET points at instead of the in-memory fake"
+    )
+    parser.add_argument("--payload-bytes", type=int, default=4096, help="Padding of inspect payloads and uploads")
+    parser.add_argument(
+        "--scenarios", nargs="+", default=list(scenarios(0)), choices=list(scenarios(0))
+    )
+    parser.add_argument("--skip-provision", action="store_true", help="Do not provision Fauna collections on startup")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,29 @@
+"""
+
+Build, push and roll out apps to the DigitalOcean registry and cluster
+
+Without arguments, prompts for one app and tag and runs the steps of
+templates/deploy.sh.j2 one after another. With a manifest, runs every app
+non-interactively with bounded concurrency:
+
+    python scripts/deploy.py --manifest apps.json --concurrency 4 --output release.json
+
+The manifest is a JSON list of apps:
+
+    [{"app": "api", "tag": "v3", "context": "services/api", "dockerfile": "Dockerfile"}]
+
+"""
+import argparse
+import asyncio
+import json
 import os
 import subprocess
+import sys
+import time
+from typing import Any as A
+from typing import Dict as D
+from typing import List as L
+from typing import Optional as O
 
 import dotenv
 import jinja2
@@ -19,13 +43,179 @@ def main():
     template = env.get_template("deploy.sh.j2")
     return template.render(app=app, tag=tag, registry=REGISTRY)
 
+
+class StepError(Exception):
+    """A deploy step exited with a non-zero status"""
+
+
+class Release:
+    """
+
+    Runs the deploy steps of one app and records how long each one took.
+
+    The image is built with `--cache-from` the image currently in the
+    registry, so unchanged layers are reused. When the rebuilt image has the
+    same id as the pulled one nothing changed, and the push and rollout are
+    skipped.
+
+    """
+
+    def __init__(self, item: D[str, A], registry: str):
+        self.app: str = item["app"]
+        self.tag: str = item.get("tag") or "latest"
+        self.context: str = item.get("context", ".")
+        self.dockerfile: O[str] = item.get("dockerfile")
+        self.remote = f"registry.digitalocean.com/{registry}/{self.app}:{self.tag}"
+        self.steps: L[D[str, A]] = []
+        self.status = "pending"
+
+    async def run(self, *command: str, check: bool = True, stdin: O[str] = None) -> str:
+        """Run one step, returning its stdout"""
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE if stdin is not None else None,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env={**os.environ, "DOCKER_BUILDKIT": "1"},
+        )
+        stdout, stderr = await process.communicate(stdin.encode() if stdin is not None else None)
+        self.steps.append(
+            {
+                "step": " ".join(command[:2]),
+                "seconds": round(time.monotonic() - started, 2),
+                "returncode": process.returncode,
+            }
+        )
+        if check and process.returncode != 0:
+            raise StepError(f"{' '.join(command)}: {stderr.decode(errors='replace').strip()[-500:]}")
+        return stdout.decode().strip()
+
+    async def image_id(self) -> O[str]:
+        """Id of the local image tagged as the registry image, if any"""
+        image = await self.run("docker", "image", "inspect", "--format", "{{.Id}}", self.remote, check=False)
+        return image or None
+
+    async def build(self) -> bool:
+        """Build with the registry image as cache, returning whether the image changed"""
+        await self.run("docker", "pull", self.remote, check=False)
+        previous = await self.image_id()
+        command = [
+            "docker", "build",
+            "--cache-from", self.remote,
+            "--build-arg", "BUILDKIT_INLINE_CACHE=1",
+            "-t", f"{self.app}:{self.tag}",
+            "-t", self.remote,
+        ]
+        if self.dockerfile:
+            command += ["-f", os.path.join(self.context, self.dockerfile)]
+        await self.run(*command, self.context)
+        return previous is None or previous != await self.image_id()
+
+    async def rollout(self):
+        """Point the deployment at the pushed image, creating and exposing it the first time"""
+        exists = await self.run("kubectl", "get", "deployment", self.app, check=False)
+        if exists:
+            await self.run("kubectl", "set", "image", f"deployment/{self.app}", f"{self.app}={self.remote}")
+            await self.run("kubectl", "rollout", "restart", f"deployment/{self.app}")
+        else:
+            await self.run("kubectl", "create", "deployment", self.app, f"--image={self.remote}")
+            await self.run(
+                "kubectl", "expose", "deployment", self.app,
+                "--type=LoadBalancer", "--port=80", "--target-port=80",
+            )
+
+    async def release(self, push: bool):
+        """Build, then push and roll out if the image changed"""
+        try:
+            changed = await self.build()
+            if not changed:
+                self.status = "unchanged"
+            elif not push:
+                self.status = "built"
+            else:
+                await self.run("docker", "push", self.remote)
+                await self.rollout()
+                self.status = "released"
+        except StepError as e:
+            self.status = "error"
+            self.steps.append({"step": "error", "message": str(e)})
+
+    def report(self) -> D[str, A]:
+        """Status and step timings"""
+        return {
+            "app": self.app,
+            "tag": self.tag,
+            "image": self.remote,
+            "status": self.status,
+            "seconds": round(sum(step.get("seconds", 0) for step in self.steps), 2),
+            "steps": self.steps,
+        }
+
+
+async def login(registry: str) -> Release:
+    """Registry login and cluster pull secret, once for the whole batch"""
+    session = Release({"app": "registry"}, registry)
+    await session.run("doctl", "registry", "login")
+    manifest = await session.run("doctl", "registry", "kubernetes-manifest")
+    await session.run("kubectl", "apply", "-f", "-", stdin=manifest)
+    patch = json.dumps({"imagePullSecrets": [{"name": f"registry-{registry}"}]})
+    await session.run("kubectl", "patch", "serviceaccount", "default", "-p", patch)
+    return session
+
+
+async def batch(manifest: L[D[str, A]], registry: str, concurrency: int, push: bool) -> D[str, A]:
+    """Release every app of the manifest, at most `concurrency` at a time"""
+    started = time.monotonic()
+    setup = await login(registry) if push else None
+    semaphore = asyncio.Semaphore(concurrency)
+    releases = [Release(item, registry) for item in manifest]
+
+    async def release(item: Release):
+        async with semaphore:
+            await item.release(push)
+
+    await asyncio.gather(*[release(item) for item in releases])
+    return {
+        "seconds": round(time.monotonic() - started, 2),
+        "setup": setup.steps if setup is not None else [],
+        "apps": [item.report() for item in releases],
+    }
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--manifest", help="JSON list of apps to release without prompting")
+    parser.add_argument("--concurrency", type=int, default=4, help="Apps built at once")
+    parser.add_argument("--registry", default=REGISTRY, help="Registry name, REGISTRY by default")
+    parser.add_argument("--no-push", action="store_true", help="Only build, do not push or roll out")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if not args.manifest:
+        script = main()
+        with open("newdeploy.sh", "w") as f:
+            f.write(script)
+        subprocess.run(["chmod", "+x", "newdeploy.sh"])
+        subprocess.run(["./newdeploy.sh"])
+        os.remove("newdeploy.sh")
+
+        print("Done!")
+        return
+    with open(args.manifest, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    try:
+        report = asyncio.run(batch(manifest, args.registry, args.concurrency, not args.no_push))
+    except StepError as e:
+        sys.exit(f"Registry setup failed: {e}")
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    if any(app["status"] == "error" for app in report["apps"]):
+        sys.exit(1)
+
+
 if __name__ == "__main__":
-    script = main()
-    with open("newdeploy.sh", "w") as f:
-        f.write(script)
-    subprocess.run(["chmod", "+x", "newdeploy.sh"])
-    subprocess.run(["./newdeploy.sh"])
-    os.remove("newdeploy.sh")
-
-    print("Done!")
-    
\ No newline at end of file
+    cli()
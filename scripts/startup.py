@@ -0,0 +1,110 @@
+"""
+
+Cold start report
+
+Imports `main` in fresh interpreters with `-X importtime` and prints a JSON
+breakdown of import and module-level init time per module and per top-level
+package, taking the median over several runs:
+
+    python scripts/startup.py --runs 5 --budget-ms 500
+
+Exits with status 1 when the median import of `main` exceeds the budget, so
+it can guard cold start in CI.
+
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict as D
+from typing import List as L
+from typing import Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def sample(module: str) -> L[Tuple[str, int, int, int]]:
+    """Import `module` once, returning (name, self us, cumulative us, depth) per import"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        raise SystemExit(result.stderr)
+    rows = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return rows
+
+
+def report(module: str, runs: int, top: int) -> D:
+    """Median timings over `runs` fresh imports"""
+    total: L[int] = []
+    packages: D[str, L[int]] = defaultdict(list)
+    modules: D[str, L[int]] = defaultdict(list)
+    local: D[str, L[int]] = defaultdict(list)
+    for _ in range(runs):
+        per_package: D[str, int] = defaultdict(int)
+        for name, self_us, cumulative_us, depth in sample(module):
+            per_package[name.split(".")[0]] += self_us
+            modules[name].append(self_us)
+            if name == module and depth == 0:
+                total.append(cumulative_us)
+            if name.startswith("kubectl"):
+                local[name].append(cumulative_us)
+        for package, self_us in per_package.items():
+            packages[package].append(self_us)
+
+    def ms(values: L[int]) -> float:
+        return round(statistics.median(values) / 1000, 2)
+
+    def ranked(timings: D[str, L[int]]) -> D[str, float]:
+        ordered = sorted(((ms(values), name) for name, values in timings.items()), reverse=True)
+        return {name: value for value, name in ordered[:top]}
+
+    return {
+        "module": module,
+        "runs": runs,
+        "total_ms": ms(total),
+        "packages_ms": ranked(packages),
+        "modules_self_ms": ranked(modules),
+        "kubectl_cumulative_ms": ranked(local),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="main", help="Module whose import is measured")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to take the median over")
+    parser.add_argument("--top", type=int, default=20, help="Entries per ranking")
+    parser.add_argument("--budget-ms", type=float, help="Fail when the median import exceeds this")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    result = report(args.module, args.runs, args.top)
+    if args.budget_ms is not None:
+        result["budget_ms"] = args.budget_ms
+        result["over_budget"] = result["total_ms"] > args.budget_ms
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    if result.get("over_budget"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""
+
+Dummy settings so kubectl modules import without a .env
+
+"""
+import os
+
+for name in (
+    "FAUNA_SECRET",
+    "API_KEY",
+    "GITHUB_TOKEN",
+    "AUTH0_DOMAIN",
+    "REDIS_PASSWORD",
+    "REDIS_HOST",
+    "REDIS_USER",
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY",
+    "AWS_S3_BUCKET",
+    "AWS_S3_ENDPOINT",
+    "CF_API_KEY",
+    "CF_EMAIL",
+    "CF_ZONE_ID",
+    "CF_ACCOUNT_ID",
+    "IP_ADDR",
+):
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("REDIS_PORT", "6379")
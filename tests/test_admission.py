@@ -0,0 +1,87 @@
+"""
+
+Caller identification of kubectl.admission
+
+"""
+import asyncio
+
+from aiohttp.test_utils import make_mocked_request
+
+from kubectl import admission as admission_module
+from kubectl.admission import LOOKUP_BURST, AdmissionController, AdmissionPolicy, Rejected
+
+
+def request(remote: str, **headers: str):
+    return make_mocked_request("POST", "/api/deploy/org/repo", headers=headers).clone(remote=remote)
+
+
+def test_address_behind_the_proxy():
+    address = AdmissionController.address
+    assert address(request("127.0.0.1", **{"X-Real-IP": "203.0.113.7"})) == "203.0.113.7"
+    assert address(request("127.0.0.1", **{"X-Forwarded-For": "10.0.0.1, 203.0.113.7"})) == "203.0.113.7"
+    assert address(request("127.0.0.1")) == "127.0.0.1"
+
+
+def test_untrusted_peers_cannot_pick_their_address():
+    spoofed = request("198.51.100.2", **{"X-Real-IP": "203.0.113.7", "X-Forwarded-For": "203.0.113.7"})
+    assert AdmissionController.address(spoofed) == "198.51.100.2"
+
+
+def test_unknown_tokens_are_looked_up_at_a_bounded_rate(monkeypatch):
+    lookups = []
+
+    async def fetch(url, headers=None):
+        lookups.append(headers["Authorization"])
+        return {"sub": headers["Authorization"]}
+
+    monkeypatch.setattr(admission_module.client, "fetch", fetch)
+    controller = AdmissionController([])
+
+    async def scenario():
+        callers = []
+        for i in range(LOOKUP_BURST + 3):
+            try:
+                callers.append(
+                    await controller.caller(request("127.0.0.1", Authorization=f"Bearer t{i}", **{"X-Real-IP": "203.0.113.7"}))
+                )
+            except Rejected:
+                callers.append(None)
+        # Known tokens are served from the cache
+        callers.append(await controller.caller(request("127.0.0.1", Authorization="Bearer t0", **{"X-Real-IP": "203.0.113.7"})))
+        return callers
+
+    callers = asyncio.run(scenario())
+    assert len(lookups) == LOOKUP_BURST
+    assert callers[:LOOKUP_BURST] == [f"user:Bearer t{i}" for i in range(LOOKUP_BURST)]
+    assert callers[LOOKUP_BURST:-1] == [None] * 3
+    assert callers[-1] == "user:Bearer t0"
+
+
+def test_admit_waits_for_tokens_up_to_a_deadline():
+    controller = AdmissionController(
+        [
+            AdmissionPolicy(
+                name="build",
+                routes=[],
+                user_rate=20.0,
+                user_burst=2,
+                route_rate=100.0,
+                route_burst=100,
+                concurrency=2,
+                queue=8,
+            )
+        ]
+    )
+
+    async def work():
+        return "ok"
+
+    async def scenario():
+        waited = [await controller.admit("build", "addr:a", work, wait=1.0) for _ in range(6)]
+        try:
+            await controller.admit("build", "addr:a", work)
+        except Rejected:
+            waited.append("rejected")
+        return waited
+
+    assert asyncio.run(scenario()) == ["ok"] * 6 + ["rejected"]
@@ -0,0 +1,30 @@
+"""
+
+Envelopes of kubectl.codecs
+
+"""
+from collections import OrderedDict
+
+import pytest
+
+from kubectl.codecs import HEADER, get_codec, pack, unpack
+
+
+@pytest.mark.parametrize("name", ["json", "marshal"])
+def test_round_trip(name):
+    value = {"items": [{"id": i, "name": f"item-{i}"} for i in range(200)]}
+    packed = pack(value, get_codec(name), compress_min=64)
+    assert len(packed) < len(get_codec(name).encode(value))
+    assert unpack(packed) == value
+
+
+def test_json_accepts_dict_subclasses():
+    assert unpack(pack(OrderedDict(a=1), get_codec("json"))) == {"a": 1}
+
+
+@pytest.mark.parametrize("compress_min", [0, 1 << 20])
+@pytest.mark.parametrize("name", ["json", "marshal"])
+def test_corrupt_payload_is_a_miss(name, compress_min):
+    packed = pack({"key": "value" * 50}, get_codec(name), compress_min=compress_min)
+    assert unpack(packed[: HEADER.size + 5]) is None
+    assert unpack(packed[: HEADER.size] + b"\xff" * 8) is None
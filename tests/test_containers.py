@@ -0,0 +1,41 @@
+"""
+
+Port tracking of kubectl.containers
+
+"""
+import asyncio
+
+from kubectl import containers as containers_module
+from kubectl.containers import ContainerIndex
+
+BINDINGS = {"8080/tcp": [{"HostIp": "", "HostPort": "40001"}]}
+
+LISTING = [
+    {"Id": "running", "Names": ["/web"], "State": "running", "Ports": [{"PrivatePort": 8080, "PublicPort": 40000}]},
+    {"Id": "stopped", "Names": ["/idle"], "State": "exited", "Ports": []},
+]
+
+
+def inspect(id_: str):
+    return {
+        "Id": id_,
+        "Name": "/idle",
+        "State": {"Status": "exited"},
+        "Config": {},
+        "HostConfig": {"PortBindings": BINDINGS},
+        "NetworkSettings": {"Ports": {}},
+    }
+
+
+def test_sync_keeps_the_bindings_of_stopped_containers(monkeypatch):
+    async def fetch(url, *args, **kwargs):
+        if url.endswith("/containers/json?all=true"):
+            return LISTING
+        return inspect(url.split("/")[-2])
+
+    monkeypatch.setattr(containers_module.client, "fetch", fetch)
+    index = ContainerIndex(url="http://docker")
+    asyncio.run(index.sync())
+    assert index.get("web").ports == [40000]
+    assert index.get("idle").ports == [40001]
+    assert index.get("idle").state == "exited"
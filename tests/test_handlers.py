@@ -0,0 +1,101 @@
+"""
+
+Query parsing of kubectl.handlers routes, served by a local TestServer
+
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiofauna")
+
+from aiohttp.test_utils import TestClient, TestServer  # pylint: disable=wrong-import-position
+
+from kubectl.handlers import app  # pylint: disable=wrong-import-position
+
+
+# An aiohttp app binds to the first loop that serves it
+LOOP = asyncio.new_event_loop()
+
+
+def serve(scenario):
+    """Run `scenario(client)` against the app"""
+
+    async def run():
+        async with TestClient(TestServer(app)) as client:
+            return await scenario(client)
+
+    return LOOP.run_until_complete(run())
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    root = tmp_path / ".vscode" / "alice" / "config" / "workspace"
+    (root / "src").mkdir(parents=True)
+    (root / "src" / "main.py").write_text("hello")
+    monkeypatch.chdir(tmp_path)
+    return root
+
+
+def browse(query: str = ""):
+    async def scenario(client):
+        nodes = []
+        async with client.ws_connect(f"/api/workspace/alice{query}") as ws:
+            async for message in ws:
+                nodes.extend(message.json())
+        return nodes
+
+    return serve(scenario)
+
+
+def test_workspace_without_query(workspace):
+    nodes = browse()
+    assert [node["path"] for node in nodes] == ["src", "src/main.py"]
+    assert "content" not in nodes[1]
+
+
+def test_workspace_content_flag(workspace):
+    assert "content" not in browse("?content=false")[1]
+    assert browse("?content=true")[1]["content"] == "hello"
+
+
+def test_workspace_max_depth(workspace):
+    nodes = browse("?max_depth=1")
+    assert [node["type"] for node in nodes] == ["directory", "truncated"]
+
+
+def test_traces_without_limit():
+    async def scenario(client):
+        for _ in range(3):
+            await client.get("/api/upstreams")
+        default = await client.get("/api/traces")
+        limited = await client.get("/api/traces", params={"limit": "1"})
+        return default.status, len(await default.json()), len(await limited.json())
+
+    status, traces, limited = serve(scenario)
+    assert status == 200
+    assert traces >= 3
+    assert limited == 1
+
+
+def test_resolve_container_after_a_rolling_redeploy(monkeypatch):
+    from kubectl import handlers  # pylint: disable=import-outside-toplevel
+    from kubectl.containers import ContainerIndex, ContainerRecord  # pylint: disable=import-outside-toplevel
+    from kubectl.models import Container  # pylint: disable=import-outside-toplevel
+
+    rolled = Container(owner="org", repo="app", name="org-app-1", user="alice", container_id="c2")
+
+    async def find_unique(field, value):
+        return rolled if (field, value) == ("name", "org-app-1") else None
+
+    index = ContainerIndex()
+    index.ready = True
+    index.put(ContainerRecord(id="c2", name="org-app-1-0123456", state="running"))
+    async def no_code_server(field, value):
+        return None
+
+    monkeypatch.setattr(handlers.Container, "find_unique", find_unique)
+    monkeypatch.setattr(handlers.CodeServer, "find_unique", no_code_server)
+    monkeypatch.setattr(handlers, "container_index", index)
+    assert LOOP.run_until_complete(handlers.resolve_container("org-app-1", "alice")) == "c2"
+    assert LOOP.run_until_complete(handlers.resolve_container("org-app-1", "bob")) is None
@@ -0,0 +1,43 @@
+"""
+
+Listing cache and file reads of kubectl.scanner
+
+"""
+from kubectl import scanner as scanner_module
+from kubectl.scanner import DirScanner
+
+
+def test_listing_cache_is_bounded(tmp_path):
+    for i in range(5):
+        (tmp_path / f"d{i}").mkdir()
+        (tmp_path / f"d{i}" / "f").write_bytes(b"x" * (i + 1))
+    scanner = DirScanner(workers=2, max_cached=3)
+    assert scanner.dir_size(str(tmp_path)) == 15
+    assert len(scanner._cache) == 3
+    assert scanner.dir_size(str(tmp_path)) == 15
+
+
+def test_unreadable_file_does_not_abort_the_walk(tmp_path, monkeypatch):
+    (tmp_path / "a.txt").write_text("a")
+    (tmp_path / "b.txt").write_text("b")
+
+    def gone(path, *args, **kwargs):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(scanner_module, "is_binary", lambda path: False)
+    monkeypatch.setattr(scanner_module, "open", gone, raising=False)
+    nodes = list(DirScanner(workers=2).iter_tree(str(tmp_path), content=True))
+    assert [node["name"] for node in nodes] == ["a.txt", "b.txt"]
+    assert all(node["unreadable"] and "content" not in node for node in nodes)
+
+
+def test_listing_does_not_open_files(tmp_path, monkeypatch):
+    (tmp_path / "a.bin").write_bytes(b"\0" * 16)
+
+    def opened(path, *args, **kwargs):
+        raise AssertionError(f"{path} was opened")
+
+    monkeypatch.setattr(scanner_module, "open", opened, raising=False)
+    (node,) = DirScanner(workers=2).iter_tree(str(tmp_path))
+    assert node["size"] == 16
+    assert "binary" not in node
@@ -0,0 +1,17 @@
+"""
+
+Span recording of kubectl.tracing
+
+"""
+from kubectl.tracing import Tracer
+
+
+def test_name_is_a_valid_attribute():
+    tracer = Tracer(sample_rate=1.0)
+    with tracer.span("GET /api/deploy", root=True):
+        with tracer.span("provision.nginx", name="site", port=40000):
+            pass
+    (trace,) = tracer.recent()
+    (child,) = trace["spans"]["children"]
+    assert child["name"] == "provision.nginx"
+    assert child["attributes"] == {"name": "site", "port": 40000}
@@ -0,0 +1,233 @@
+"""
+
+Circuit breaker, retry budget, deadlines and hedging of kubectl.upstreams,
+against local fake upstreams that inject delays and errors
+
+"""
+import asyncio
+import time
+
+import pytest
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from kubectl.client import client
+from kubectl.upstreams import CircuitOpenError, Upstream, UpstreamError, UpstreamPolicy, upstreams
+
+
+def upstream(**overrides) -> Upstream:
+    policy = {
+        "name": "test",
+        "base_url": "http://upstream",
+        "retries": 0,
+        "failure_threshold": 1,
+        "reset_timeout": 0.05,
+        **overrides,
+    }
+    return Upstream(UpstreamPolicy(**policy))
+
+
+async def fail():
+    raise UpstreamError("down", 503)
+
+
+async def ok():
+    return "ok"
+
+
+def test_breaker_opens_then_recovers_through_a_probe():
+    async def scenario():
+        up = upstream()
+        with pytest.raises(UpstreamError):
+            await up.call("GET", fail)
+        with pytest.raises(CircuitOpenError):
+            await up.call("GET", ok)
+        await asyncio.sleep(0.06)
+        assert await up.call("GET", ok) == "ok"
+        assert up.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_probe_does_not_wedge_the_breaker():
+    async def scenario():
+        up = upstream()
+        with pytest.raises(UpstreamError):
+            await up.call("GET", fail)
+        await asyncio.sleep(0.06)
+        assert up.breaker.state == "half_open"
+
+        probe = asyncio.ensure_future(up.call("GET", lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0.01)
+        assert up.breaker.probing
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        assert not up.breaker.probing
+        for _ in range(3):
+            assert await up.call("GET", ok) == "ok"
+
+    asyncio.run(scenario())
+
+
+class FakeUpstream:
+    """
+
+    Local HTTP server answering each request with the next `(delay, status)`
+    of its script, the last one repeating
+
+    """
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.hits = 0
+        self.server = TestServer(web.Application())
+        self.server.app.router.add_route("*", "/{tail:.*}", self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        delay, status = self.script[min(self.hits, len(self.script) - 1)]
+        self.hits += 1
+        await asyncio.sleep(delay)
+        return web.json_response({"hit": self.hits}, status=status)
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+    @property
+    def url(self) -> str:
+        return str(self.server.make_url(""))
+
+
+def register(fake: FakeUpstream, **overrides) -> Upstream:
+    """Route `client` calls to the fake through a policy of its own"""
+    policy = {
+        "name": "fake",
+        "base_url": fake.url,
+        "backoff": 0.0,
+        "failure_threshold": 100,
+        **overrides,
+    }
+    return upstreams.register(UpstreamPolicy(**policy))
+
+
+@pytest.fixture(autouse=True)
+def unregister():
+    yield
+    upstreams.upstreams.pop("fake", None)
+
+
+def test_retries_stop_when_the_budget_is_spent():
+    async def scenario():
+        async with FakeUpstream((0, 503)) as fake:
+            up = register(fake, retries=5, retry_ratio=0.0, retry_burst=2.0)
+            with pytest.raises(UpstreamError):
+                await client.fetch(f"{fake.url}/a")
+            assert fake.hits == 3
+            assert up.retries == 2
+
+            # An empty budget leaves only the first attempt
+            with pytest.raises(UpstreamError):
+                await client.fetch(f"{fake.url}/b")
+            assert fake.hits == 4
+            assert up.retries == 2
+            assert up.stats()["errors"] == 4
+
+    asyncio.run(scenario())
+
+
+def test_budget_refills_with_traffic():
+    async def scenario():
+        async with FakeUpstream((0, 200)) as fake:
+            up = register(fake, retry_ratio=0.5, retry_burst=2.0)
+            up.budget.tokens = 0.0
+            await client.fetch(f"{fake.url}/a")
+            await client.fetch(f"{fake.url}/b")
+            assert up.budget.tokens == 1.0
+
+            fake.script = [(0, 503), (0, 200)]
+            fake.hits = 0
+            assert await client.fetch(f"{fake.url}/c") == {"hit": 2}
+            assert up.budget.tokens == 0.5
+
+    asyncio.run(scenario())
+
+
+def test_slow_attempt_times_out_and_is_retried():
+    async def scenario():
+        async with FakeUpstream((1.0, 200), (0, 200)) as fake:
+            up = register(fake, timeout=0.1, retries=1)
+            started = time.monotonic()
+            assert await client.fetch(f"{fake.url}/a") == {"hit": 2}
+            assert time.monotonic() - started < 0.5
+            assert (up.errors, up.retries) == (1, 1)
+
+    asyncio.run(scenario())
+
+
+def test_deadline_applies_to_every_attempt():
+    async def scenario():
+        async with FakeUpstream((1.0, 200)) as fake:
+            up = register(fake, timeout=0.1, retries=2)
+            started = time.monotonic()
+            with pytest.raises(asyncio.TimeoutError):
+                await client.fetch(f"{fake.url}/a")
+            assert time.monotonic() - started < 0.8
+            assert fake.hits == 3
+            assert up.errors == 3
+
+    asyncio.run(scenario())
+
+
+def test_hedged_get_returns_the_first_response_and_cancels_the_loser():
+    async def scenario():
+        async with FakeUpstream((1.0, 200), (0, 200)) as fake:
+            up = upstream(hedge_after=0.05, timeout=5.0)
+            cancelled = []
+
+            async def send():
+                try:
+                    async with ClientSession() as session:
+                        async with session.get(f"{fake.url}/a") as response:
+                            return await response.json()
+                except asyncio.CancelledError:
+                    cancelled.append(fake.hits)
+                    raise
+
+            started = time.monotonic()
+            assert await up.call("GET", send) == {"hit": 2}
+            assert time.monotonic() - started < 0.5
+            assert fake.hits == 2
+            assert up.hedges == 1
+            # The loser unwinds on the next loop iterations
+            await asyncio.sleep(0.05)
+            assert cancelled == [2]
+
+    asyncio.run(scenario())
+
+
+def test_hedge_is_skipped_for_fast_responses_and_writes():
+    async def scenario():
+        async with FakeUpstream((0.2, 200)) as fake:
+            register(fake, hedge_after=0.05)
+            assert await client.fetch(f"{fake.url}/a", "PUT") == {"hit": 1}
+            fake.script = [(0, 200)]
+            assert await client.fetch(f"{fake.url}/b") == {"hit": 2}
+            assert fake.hits == 2
+            assert upstreams.upstreams["fake"].hedges == 0
+
+    asyncio.run(scenario())
+
+
+def test_hedged_get_survives_one_failing_attempt():
+    async def scenario():
+        async with FakeUpstream((0.1, 503), (0.2, 200)) as fake:
+            up = register(fake, hedge_after=0.05, retries=0)
+            assert await client.fetch(f"{fake.url}/a") == {"hit": 2}
+            assert (up.hedges, up.errors) == (1, 1)
+
+    asyncio.run(scenario())